@@ -0,0 +1,491 @@
+"""
+قياس أداء crypto.py بدون أي اتصال خارجي.
+
+يشغل تطبيق aiohttp الخاص بالبوت محلياً، ويستبدل Telegram وCMC وGroq وBinance وNOWPayments
+بسيرفرات وهمية (مع تأخير وأخطاء قابلة للضبط) وقاعدة Postgres مؤقتة، ثم يرسل تحديثات
+اصطناعية بمعدل ثابت ويطبع: الإنتاجية، مئينات زمن الرد، استعلامات DB وطلبات المزودين لكل تحديث.
+
+أمثلة:
+    python bench.py --rate 100 --duration 30
+    python bench.py --mix lookup=5,analyze=3,payment=1 --latency groq=1500 --error-rate groq=0.05
+    python bench.py --database-url postgresql://localhost/bench --mode queue --broadcast
+
+ملاحظات:
+- initdb يرفض العمل كـ root؛ في هذه الحالة استخدم --database-url لقاعدة فارغة مخصصة للقياس.
+- السيرفرات الوهمية تعمل في thread منفصل بحلقة أحداث خاصة بها، والمولّد مفتوح الحلقة (لا ينتظر الرد قبل الإرسال التالي).
+"""
+import argparse
+import asyncio
+import contextlib
+import glob
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from aiohttp import ClientSession, web
+
+UPSTREAM_NAMES = ("telegram", "cmc", "groq", "binance", "nowpayments")
+REAL_SYMBOLS = ["BTC", "ETH", "SOL", "BNB", "XRP", "ADA", "DOGE", "TON", "AVAX", "DOT", "LINK", "TRX", "MATIC", "LTC", "SHIB"]
+TIMEFRAMES = ("tf_weekly", "tf_daily", "tf_4h")
+USER_BASE = 10_000_000
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def parse_pairs(text, cast=float):
+    pairs = {}
+    for item in filter(None, (text or "").split(",")):
+        key, _, value = item.partition("=")
+        pairs[key.strip()] = cast(value)
+    return pairs
+
+
+def percentile(values, p):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+# --- قاعدة Postgres مؤقتة ---
+@contextlib.contextmanager
+def throwaway_postgres():
+    bindirs = [os.path.dirname(p) for p in filter(None, [shutil.which("initdb")])]
+    bindirs += sorted(glob.glob("/usr/lib/postgresql/*/bin"), reverse=True)
+    bindir = next((d for d in bindirs if os.path.exists(os.path.join(d, "pg_ctl"))), None)
+    if bindir is None:
+        sys.exit("initdb/pg_ctl not found; install PostgreSQL or pass --database-url")
+
+    tmp = tempfile.mkdtemp(prefix="bench-pg-")
+    data, port = os.path.join(tmp, "data"), free_port()
+    try:
+        subprocess.run([os.path.join(bindir, "initdb"), "-D", data, "-U", "bench", "-A", "trust"],
+                       check=True, stdout=subprocess.DEVNULL)
+        subprocess.run([os.path.join(bindir, "pg_ctl"), "-D", data, "-l", os.path.join(tmp, "pg.log"), "-w",
+                        "-o", f"-p {port} -k {tmp} -c listen_addresses='' -c fsync=off", "start"],
+                       check=True, stdout=subprocess.DEVNULL)
+        yield f"postgresql://bench@/postgres?host={tmp}&port={port}"
+    finally:
+        subprocess.run([os.path.join(bindir, "pg_ctl"), "-D", data, "-m", "fast", "stop"],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+# --- السيرفرات الوهمية للمزودين ---
+class MockUpstreams:
+    def __init__(self, latency_ms, error_rate, universe):
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.calls = {name: 0 for name in UPSTREAM_NAMES}
+        self.errors = {name: 0 for name in UPSTREAM_NAMES}
+        self.urls = {}
+        self._ids = itertools.count(1)
+        self.coins = [self._coin(i, sym) for i, sym in enumerate(universe, 1)]
+        self.by_symbol = {c["symbol"]: c for c in self.coins}
+        self._loop = asyncio.new_event_loop()
+        self._runners = []
+
+    @staticmethod
+    def _coin(i, sym):
+        price = 60000 / i ** 1.5
+        return {"id": i, "name": sym.title(), "symbol": sym, "slug": sym.lower(), "cmc_rank": i, "tags": [],
+                "quote": {"USD": {"price": price, "volume_24h": 1e9 / i, "volume_change_24h": 0.0,
+                                  "percent_change_1h": 0.0, "percent_change_24h": 0.0, "percent_change_7d": 0.0,
+                                  "market_cap": price * 1e7}}}
+
+    def _middleware(self, name):
+        @web.middleware
+        async def middleware(request, handler):
+            self.calls[name] += 1
+            delay = self.latency_ms.get(name, 0) / 1000
+            if delay:
+                await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+            if random.random() < self.error_rate.get(name, 0):
+                self.errors[name] += 1
+                if name == "telegram":
+                    return web.json_response({"ok": False, "error_code": 500, "description": "Injected error"}, status=500)
+                return web.json_response({"error": "injected"}, status=503)
+            return await handler(request)
+        return middleware
+
+    # Telegram Bot API
+    async def telegram(self, request):
+        method = request.match_info["method"]
+        form = await request.post()
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif method in ("sendMessage", "editMessageText", "sendInvoice"):
+            result = {"message_id": next(self._ids), "date": int(time.time()),
+                      "chat": {"id": int(form.get("chat_id") or 0), "type": "private"}, "text": form.get("text", "")}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    # CoinMarketCap
+    async def cmc_quotes(self, request):
+        syms = request.query.get("symbol", "").split(",")
+        data = {s: self.by_symbol[s] for s in syms if s in self.by_symbol}
+        return web.json_response({"status": {"credit_count": 1}, "data": data})
+
+    async def cmc_listings(self, request):
+        for c in self.coins:
+            q = c["quote"]["USD"]
+            q["price"] *= random.uniform(0.99, 1.01)
+            q["volume_24h"] *= random.uniform(0.9, 1.1)
+        limit = int(request.query.get("limit", len(self.coins)))
+        return web.json_response({"status": {"credit_count": 1 + limit // 200}, "data": self.coins[:limit]})
+
+    async def cmc_map(self, request):
+        return web.json_response({"status": {"credit_count": 1}, "data": [
+            {"id": c["id"], "symbol": c["symbol"], "name": c["name"], "slug": c["slug"], "rank": c["cmc_rank"]}
+            for c in self.coins
+        ]})
+
+    # Groq (OpenAI-compatible)
+    async def groq(self, request):
+        data = await request.json()
+        prompt = data["messages"][-1]["content"]
+        if (data.get("response_format") or {}).get("type") == "json_object":
+            text = json.dumps({key: "Breakout above resistance with rising volume." for key in re.findall(r'- "(\w+)":', prompt)})
+        else:
+            text = ("📊 <b>Market Overview</b>\nTrend: Bullish\n\n📉 <b>Support & Resistance</b>\n"
+                    "Nearest Support: 1.00\nNearest Resistance: 1.20\n\n🎯 <b>Price Targets</b>\nTP1: 1.1\nTP2: 1.2\nTP3: 1.3")
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(text) // 4}
+        if not data.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": text}}], "usage": usage})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        step = max(1, len(text) // 8)
+        for i in range(0, len(text), step):
+            chunk = {"choices": [{"delta": {"content": text[i:i + step]}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.01)
+        await response.write(f"data: {json.dumps({'choices': [], 'x_groq': {'usage': usage}})}\n\ndata: [DONE]\n\n".encode())
+        return response
+
+    # Binance
+    async def klines(self, request):
+        limit = int(request.query.get("limit", 200))
+        now, price, rows = int(time.time() * 1000), 100.0, []
+        for i in range(limit):
+            o, price = price, price * random.uniform(0.98, 1.02)
+            rows.append([now - (limit - i) * 3600_000, o, max(o, price) * 1.005, min(o, price) * 0.995, price,
+                         random.uniform(1e3, 1e4), 0, "0", 0, "0", "0", "0"])
+        return web.json_response(rows)
+
+    # NOWPayments
+    async def nowpayments(self, request):
+        path = request.match_info["path"]
+        if path == "invoice":
+            iid = next(self._ids)
+            return web.json_response({"id": iid, "invoice_url": f"https://nowpayments.io/payment/?iid={iid}"})
+        if path == "auth":
+            return web.json_response({"token": "bench"})
+        return web.json_response({"data": [], "pagesCount": 0})
+
+    def _apps(self):
+        routes = {
+            "telegram": [web.post("/bot{token}/{method}", self.telegram)],
+            "cmc": [web.get("/v1/cryptocurrency/quotes/latest", self.cmc_quotes),
+                    web.get("/v1/cryptocurrency/listings/latest", self.cmc_listings),
+                    web.get("/v1/cryptocurrency/map", self.cmc_map)],
+            "groq": [web.post("/openai/v1/chat/completions", self.groq)],
+            "binance": [web.get("/api/v3/klines", self.klines)],
+            "nowpayments": [web.route("*", "/v1/{path:.*}", self.nowpayments)],
+        }
+        for name, r in routes.items():
+            app = web.Application(middlewares=[self._middleware(name)])
+            app.add_routes(r)
+            yield name, app
+
+    async def _start(self):
+        for name, app in self._apps():
+            runner = web.AppRunner(app, access_log=None)
+            await runner.setup()
+            port = free_port()
+            await web.TCPSite(runner, "127.0.0.1", port).start()
+            self._runners.append(runner)
+            self.urls[name] = f"http://127.0.0.1:{port}"
+
+    def start(self):
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(self._loop)
+            self._loop.run_until_complete(self._start())
+            ready.set()
+            self._loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+    def stop(self):
+        async def cleanup():
+            for runner in self._runners:
+                await runner.cleanup()
+        asyncio.run_coroutine_threadsafe(cleanup(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+# --- مولّد التحديثات ---
+class LoadGenerator:
+    def __init__(self, crypto, base_url, users, universe, timeout):
+        self.crypto = crypto
+        self.base_url = base_url
+        self.users = users
+        self.universe = universe
+        self.timeout = timeout
+        self.update_ids = itertools.count(1)
+        self.payment_ids = itertools.count(1)
+        self.pending = {}
+        self.ack, self.e2e = [], []
+        self.status = {}
+        self.lost = 0
+        self.completed = 0
+
+        original = crypto.dp.feed_update
+
+        async def tracked(bot, update, **kwargs):
+            try:
+                return await original(bot, update, **kwargs)
+            finally:
+                future = self.pending.pop(update.update_id, None)
+                if future is not None and not future.done():
+                    future.set_result(time.perf_counter())
+
+        crypto.dp.feed_update = tracked
+
+    @staticmethod
+    def _user(uid):
+        return {"id": uid, "is_bot": False, "first_name": f"U{uid}", "language_code": "en"}
+
+    def _message(self, uid, **fields):
+        return {"message_id": next(self.update_ids), "date": int(time.time()),
+                "chat": {"id": uid, "type": "private"}, "from": self._user(uid), **fields}
+
+    async def post(self, session, path, body, headers=None):
+        started = time.perf_counter()
+        async with session.post(self.base_url + path, data=json.dumps(body), headers=headers) as res:
+            await res.read()
+        self.ack.append(time.perf_counter() - started)
+        self.status[res.status] = self.status.get(res.status, 0) + 1
+        return res.status, started
+
+    async def send_update(self, session, uid, **payload):
+        update_id = next(self.update_ids)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[update_id] = future
+        status, started = await self.post(session, "/", {"update_id": update_id, **payload},
+                                          {"X-Telegram-Bot-Api-Secret-Token": self.crypto.SECRET_TOKEN})
+        if status != 200:
+            self.pending.pop(update_id, None)
+            return False
+        try:
+            finished = await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self.pending.pop(update_id, None)
+            self.lost += 1
+            return False
+        self.e2e.append(finished - started)
+        self.completed += 1
+        return True
+
+    # السيناريوهات
+    async def lookup(self, session, uid):
+        sym = random.choice(self.universe) if random.random() > 0.1 else random.choice(self.universe) + "Q"
+        await self.send_update(session, uid, message=self._message(uid, text=sym))
+
+    async def multi(self, session, uid):
+        text = " ".join(random.sample(self.universe, 3))
+        await self.send_update(session, uid, message=self._message(uid, text=text))
+
+    async def analyze(self, session, uid):
+        if not await self.send_update(session, uid, message=self._message(uid, text=random.choice(REAL_SYMBOLS))):
+            return
+        await self.send_update(session, uid, callback_query={
+            "id": str(next(self.update_ids)), "from": self._user(uid), "chat_instance": str(uid),
+            "data": random.choice(TIMEFRAMES), "message": self._message(uid, text="menu"),
+        })
+
+    async def payment(self, session, uid):
+        if random.random() < 0.5:
+            await self.send_update(session, uid, message=self._message(uid, successful_payment={
+                "currency": "XTR", "total_amount": 500, "invoice_payload": "stars_pay",
+                "telegram_payment_charge_id": f"bench-{uid}", "provider_payment_charge_id": f"bench-{uid}",
+            }))
+            return
+        # IPN لا يمر عبر الـ Dispatcher، فنقيس زمن الرد فقط
+        ipn = {"payment_id": next(self.payment_ids), "invoice_id": None, "order_id": str(uid),
+               "payment_status": "finished", "price_amount": 10, "price_currency": "usd"}
+        status, _ = await self.post(session, "/webhook/nowpayments", ipn,
+                                    {"x-nowpayments-sig": self.crypto.nowpayments_signature(ipn)})
+        if status == 200:
+            self.completed += 1
+
+    async def run(self, rate, duration, mix):
+        scenarios = [getattr(self, name) for name in mix]
+        weights = list(mix.values())
+        tasks, started = [], time.perf_counter()
+        async with ClientSession() as session:
+            for i in itertools.count():
+                at = started + i / rate
+                if at - started >= duration:
+                    break
+                await asyncio.sleep(max(0.0, at - time.perf_counter()))
+                scenario = random.choices(scenarios, weights)[0]
+                uid = USER_BASE + random.randrange(self.users)
+                tasks.append(asyncio.create_task(scenario(session, uid)))
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return time.perf_counter() - started
+
+
+def query_count(crypto):
+    return sum(row[-1] for row in crypto.db_query_seconds.series.values())
+
+
+async def pause_scheduled_jobs(database_url):
+    # قاعدة جديدة بلا scheduler_state تعني أن الرادار ومنشور القناة ينطلقان فوراً ويشوّهان القياس،
+    # لذلك نؤجلهما يوماً قبل تشغيل التطبيق (الجدول نفسه الذي تنشئه هجرات crypto)
+    import asyncpg
+    conn = await asyncpg.connect(database_url)
+    try:
+        await conn.execute("CREATE TABLE IF NOT EXISTS scheduler_state (name TEXT PRIMARY KEY, next_run_at TIMESTAMPTZ)")
+        await conn.execute("""
+            INSERT INTO scheduler_state (name, next_run_at)
+            SELECT unnest($1::text[]), now() + interval '1 day'
+            ON CONFLICT (name) DO UPDATE SET next_run_at = EXCLUDED.next_run_at
+        """, ["radar", "channel_post"])
+    finally:
+        await conn.close()
+
+
+async def run_benchmark(args, database_url):
+    universe = REAL_SYMBOLS + [f"X{i:03d}" for i in range(args.universe - len(REAL_SYMBOLS))]
+    mocks = MockUpstreams(parse_pairs(args.latency), parse_pairs(args.error_rate), universe)
+    mocks.start()
+
+    # كل الإعدادات تُقرأ عند استيراد crypto، لذلك تُضبط البيئة قبله
+    tmp = tempfile.mkdtemp(prefix="bench-")
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK", "WEBHOOK_URL": mocks.urls["telegram"], "DATABASE_URL": database_url,
+        "CMC_API_KEY": "bench", "GROQ_API_KEY": "bench", "NOWPAYMENTS_API_KEY": "bench",
+        "NOWPAYMENTS_IPN_SECRET": "bench-secret", "SCALE_MODE": args.mode, "PROCESS_ROLE": "all",
+        "SYMBOL_SNAPSHOT_PATH": os.path.join(tmp, "symbols.json"),
+        "USER_RATE": "1000", "USER_BURST": "1000", "SESSION_BACKEND": "memory",
+    })
+    import crypto
+    from aiogram.client.telegram import TelegramAPIServer
+
+    for name in ("cmc", "groq", "binance", "nowpayments"):
+        crypto.UPSTREAMS[name]["base_url"] = mocks.urls[name]
+    crypto.bot.session.api = TelegramAPIServer.from_base(mocks.urls["telegram"])
+
+    await pause_scheduled_jobs(database_url)
+    port = free_port()
+    runner = web.AppRunner(crypto.app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    pool = crypto.app['db_pool']
+    try:
+        await pool.execute("""
+            INSERT INTO users_info (user_id, lang, is_paid)
+            SELECT g, CASE WHEN g % 2 = 0 THEN 'ar' ELSE 'en' END, g % 3 <> 0
+            FROM generate_series($1::bigint, $2::bigint) g
+            ON CONFLICT (user_id) DO NOTHING
+        """, USER_BASE, USER_BASE + args.users - 1)
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(crypto.market_data.ready.wait(), 10)
+        deadline = time.monotonic() + 10
+        while not len(crypto.symbol_index) and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if not len(crypto.symbol_index):
+            print("warning: symbol index still empty after 10s (/v1/cryptocurrency/map failed?)", file=sys.stderr)
+
+        generator = LoadGenerator(crypto, f"http://127.0.0.1:{port}", args.users, universe, args.timeout)
+        calls_before, queries_before = dict(mocks.calls), query_count(crypto)
+        elapsed = await generator.run(args.rate, args.duration, parse_pairs(args.mix, int))
+        calls = {n: mocks.calls[n] - calls_before[n] for n in UPSTREAM_NAMES}
+        queries = query_count(crypto) - queries_before
+
+        report = {
+            "mode": args.mode,
+            "target_rate": args.rate,
+            "duration_s": round(elapsed, 2),
+            "completed": generator.completed,
+            "throughput_per_s": round(generator.completed / elapsed, 2),
+            "lost": generator.lost,
+            "http_status": generator.status,
+            "ack_ms": {f"p{p}": round(percentile(generator.ack, p) * 1000, 2) for p in (50, 95, 99)},
+            "e2e_ms": {f"p{p}": round(percentile(generator.e2e, p) * 1000, 2) for p in (50, 95, 99)},
+            "db_queries_per_update": round(queries / max(1, generator.completed), 2) if queries else None,
+            "upstream_calls_per_update": {n: round(c / max(1, generator.completed), 3) for n, c in calls.items()},
+            "injected_errors": dict(mocks.errors),
+        }
+
+        if args.broadcast:
+            started = time.perf_counter()
+            job_id = await crypto.broadcast(pool, lambda is_paid, lang: (f"bench {lang}", None), label="bench")
+            while await pool.fetchval("SELECT status FROM broadcast_jobs WHERE job_id = $1", job_id) != "done":
+                await asyncio.sleep(0.5)
+            took = time.perf_counter() - started
+            recipients = await pool.fetchval("SELECT count(*) FROM broadcast_deliveries WHERE job_id = $1", job_id)
+            report["broadcast"] = {"recipients": recipients, "seconds": round(took, 2),
+                                   "per_s": round(recipients / took, 2)}
+        return report
+    finally:
+        await runner.cleanup()
+        mocks.stop()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+def print_report(report):
+    print("\n📊 Benchmark report")
+    print("───────────────────")
+    for key, value in report.items():
+        if isinstance(value, dict):
+            value = "  ".join(f"{k}={v}" for k, v in value.items())
+        print(f"{key:28} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline load test for crypto.py")
+    parser.add_argument("--rate", type=float, default=50, help="updates per second")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of load")
+    parser.add_argument("--users", type=int, default=1000, help="seeded users")
+    parser.add_argument("--universe", type=int, default=500, help="symbols served by the CMC mock")
+    parser.add_argument("--mix", default="lookup=6,multi=1,analyze=2,payment=1", help="scenario weights")
+    parser.add_argument("--latency", default="telegram=30,cmc=150,groq=800,binance=50,nowpayments=100", help="mock latency in ms")
+    parser.add_argument("--error-rate", default="", help="injected error probability per upstream, e.g. groq=0.05")
+    parser.add_argument("--mode", choices=("single", "queue"), default="single", help="SCALE_MODE under test")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds before an update counts as lost")
+    parser.add_argument("--broadcast", action="store_true", help="time a broadcast to all seeded users after the load")
+    parser.add_argument("--database-url", help="use this empty database instead of a throwaway cluster")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        database_url = args.database_url or stack.enter_context(throwaway_postgres())
+        report = asyncio.run(run_benchmark(args, database_url))
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,6 +7,19 @@ import hashlib
 import asyncpg
 import httpx
 import random
+import math
+import time
+import bisect
+from collections import OrderedDict, deque
+try:
+    import numpy as np
+except ImportError:
+    np = None
+try:
+    import orjson
+    json_loads = orjson.loads  # أسرع بعدة مرات ويقرأ البايتات مباشرة
+except ImportError:
+    json_loads = json.loads
 from aiohttp import web
 from dotenv import load_dotenv
 
@@ -16,6 +29,10 @@ from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, LabeledPrice, PreCheckoutQuery
 from aiogram.client.default import DefaultBotProperties
 from aiogram.filters import Command
+from aiogram.exceptions import (
+    TelegramAPIError, TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest,
+    TelegramNetworkError, TelegramServerError,
+)
 
 # --- تحميل الإعدادات ---
 load_dotenv()
@@ -29,29 +46,1353 @@ PORT = int(os.getenv("PORT", 10000))
 
 NOWPAYMENTS_API_KEY = os.getenv("NOWPAYMENTS_API_KEY")
 NOWPAYMENTS_IPN_SECRET = os.getenv("NOWPAYMENTS_IPN_SECRET")
+# حساب لوحة NOWPayments (مطلوب فقط لمطابقة الفواتير التي لم يصل لها IPN)
+NOWPAYMENTS_EMAIL = os.getenv("NOWPAYMENTS_EMAIL")
+NOWPAYMENTS_PASSWORD = os.getenv("NOWPAYMENTS_PASSWORD")
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", 900))
 DATABASE_URL = os.getenv("DATABASE_URL")
 ADMIN_USER_ID = 6172153716
 
 GROQ_MODEL = "meta-llama/llama-4-scout-17b-16e-instruct"
+GROQ_FALLBACK_MODEL = os.getenv("GROQ_FALLBACK_MODEL", "llama-3.1-8b-instant")
+GROQ_LATENCY_SLO = float(os.getenv("GROQ_LATENCY_SLO", 15))
+GROQ_MAX_RETRIES = int(os.getenv("GROQ_MAX_RETRIES", 3))
+GROQ_BACKOFF_BASE = float(os.getenv("GROQ_BACKOFF_BASE", 0.5))
+GROQ_BACKOFF_MAX = float(os.getenv("GROQ_BACKOFF_MAX", 20))
+GROQ_BREAKER_THRESHOLD = int(os.getenv("GROQ_BREAKER_THRESHOLD", 5))
+GROQ_BREAKER_COOLDOWN = float(os.getenv("GROQ_BREAKER_COOLDOWN", 30))
+GROQ_TOKENS_PER_CALL = int(os.getenv("GROQ_TOKENS_PER_CALL", 1500))
+
+# --- إعدادات اتصالات HTTP (قابلة للتعديل من البيئة) ---
+HTTP_TIMEOUT_CMC = float(os.getenv("HTTP_TIMEOUT_CMC", 10))
+HTTP_TIMEOUT_GROQ = float(os.getenv("HTTP_TIMEOUT_GROQ", 45))
+HTTP_TIMEOUT_NOWPAYMENTS = float(os.getenv("HTTP_TIMEOUT_NOWPAYMENTS", 20))
+HTTP_MAX_CONCURRENCY_CMC = int(os.getenv("HTTP_MAX_CONCURRENCY_CMC", 10))
+HTTP_MAX_CONCURRENCY_GROQ = int(os.getenv("HTTP_MAX_CONCURRENCY_GROQ", 20))
+HTTP_MAX_CONCURRENCY_NOWPAYMENTS = int(os.getenv("HTTP_MAX_CONCURRENCY_NOWPAYMENTS", 5))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 60))
+
+# --- إعدادات المراقبة ---
+METRICS_SAMPLE_INTERVAL = float(os.getenv("METRICS_SAMPLE_INTERVAL", 1))
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))  # لعمليات worker التي لا تشغل سيرفر الويب
+HEALTH_DB_TIMEOUT = float(os.getenv("HEALTH_DB_TIMEOUT", 2))
+
+# --- إعدادات كاش الأسعار ---
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", 60))
+QUOTE_CACHE_MAX = int(os.getenv("QUOTE_CACHE_MAX", 2000))
+
+# --- إعدادات خدمة بيانات السوق المشتركة ---
+MARKET_UNIVERSE = int(os.getenv("MARKET_UNIVERSE", 1000))
+MARKET_POLL_INTERVAL = float(os.getenv("MARKET_POLL_INTERVAL", 300))
+MARKET_MAX_AGE = float(os.getenv("MARKET_MAX_AGE", 600))
+MARKET_FOLLOW_INTERVAL = float(os.getenv("MARKET_FOLLOW_INTERVAL", 30))
+MARKET_CREDIT_BUDGET_HOURLY = float(os.getenv("MARKET_CREDIT_BUDGET_HOURLY", 100))
+QUOTE_BATCH_WINDOW = float(os.getenv("QUOTE_BATCH_WINDOW", 0.05))
+QUOTE_BATCH_MAX = int(os.getenv("QUOTE_BATCH_MAX", 100))
+MAX_SYMBOLS_PER_MESSAGE = int(os.getenv("MAX_SYMBOLS_PER_MESSAGE", 10))
+
+# --- إعدادات فهرس الرموز المحلي ---
+SYMBOL_INDEX_REFRESH = float(os.getenv("SYMBOL_INDEX_REFRESH", 21600))
+SYMBOL_SNAPSHOT_PATH = os.getenv("SYMBOL_SNAPSHOT_PATH", "symbols_snapshot.json")
+
+# --- إعدادات البث الجماعي (حد تيليجرام العام ~30 رسالة/ثانية) ---
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 20))
+BROADCAST_MAX_RETRIES = int(os.getenv("BROADCAST_MAX_RETRIES", 3))
+ENTITLEMENT_TTL = float(os.getenv("ENTITLEMENT_TTL", 60))
+ENTITLEMENT_CACHE_MAX = int(os.getenv("ENTITLEMENT_CACHE_MAX", 50000))
+ACTIVITY_FLUSH_INTERVAL = float(os.getenv("ACTIVITY_FLUSH_INTERVAL", 5))
+
+# --- إعدادات كاش التحليلات ---
+ANALYSIS_PRICE_BUCKET_PCT = float(os.getenv("ANALYSIS_PRICE_BUCKET_PCT", 0.5))
+ANALYSIS_CACHE_MAX = int(os.getenv("ANALYSIS_CACHE_MAX", 5000))
+ANALYSIS_CACHE_PERSIST = os.getenv("ANALYSIS_CACHE_PERSIST", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", 1.2))
+
+# --- إعدادات الشموع والمؤشرات ---
+OHLCV_FIXTURE_DIR = os.getenv("OHLCV_FIXTURE_DIR")
+CANDLE_WINDOW = int(os.getenv("CANDLE_WINDOW", 300))
+CANDLE_STORE_MAX = int(os.getenv("CANDLE_STORE_MAX", 2000))  # كل سلسلة ~14KB
+CANDLE_INTERVALS = {"weekly": "1w", "daily": "1d", "4h": "4h"}
+CANDLE_REFRESH = {"weekly": 1800, "daily": 300, "4h": 60}
+ANALYSIS_TTL = {
+    "weekly": float(os.getenv("ANALYSIS_TTL_WEEKLY", 6 * 3600)),
+    "daily": float(os.getenv("ANALYSIS_TTL_DAILY", 3600)),
+    "4h": float(os.getenv("ANALYSIS_TTL_4H", 900)),
+}
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 200))
+BROADCAST_CLAIM_TIMEOUT = float(os.getenv("BROADCAST_CLAIM_TIMEOUT", 300))
+BROADCAST_POLL_INTERVAL = float(os.getenv("BROADCAST_POLL_INTERVAL", 5))
+RADAR_INTERVAL = 84000
+
+# --- إعدادات التحكم في قبول التحديثات ---
+MAX_INFLIGHT_UPDATES = int(os.getenv("MAX_INFLIGHT_UPDATES", 200))
+INGRESS_QUEUE_SIZE = int(os.getenv("INGRESS_QUEUE_SIZE", 2000))
+USER_RATE = float(os.getenv("USER_RATE", 1))
+USER_BURST = float(os.getenv("USER_BURST", 5))
+USER_LIMITER_MAX = int(os.getenv("USER_LIMITER_MAX", 100000))
+
+# --- إعدادات التوسع الأفقي ---
+SCALE_MODE = os.getenv("SCALE_MODE", "single")  # single | queue (طابور تحديثات مشترك في Postgres)
+PROCESS_ROLE = os.getenv("PROCESS_ROLE", "all")  # all | web | worker
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", 8))
+UPDATE_QUEUE_POLL = float(os.getenv("UPDATE_QUEUE_POLL", 5))  # احتياطي فقط؛ العمال يستيقظون عبر LISTEN/NOTIFY
+UPDATE_CLAIM_TIMEOUT = float(os.getenv("UPDATE_CLAIM_TIMEOUT", 120))
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", 15))
+
+# --- إعدادات ماسح الإشارات ---
+SCAN_HISTORY = int(os.getenv("SCAN_HISTORY", 96))
+SCAN_MOMENTUM_LOOKBACK = int(os.getenv("SCAN_MOMENTUM_LOOKBACK", 12))
+SCAN_MIN_VOLUME = float(os.getenv("SCAN_MIN_VOLUME", 1_000_000))
+CHANNEL_POST_INTERVAL = 21600
+
+# --- إعدادات الجلسات ---
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")  # memory | postgres | redis
+SESSION_TTL = float(os.getenv("SESSION_TTL", 1800))
+SESSION_MAX = int(os.getenv("SESSION_MAX", 20000))
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
 
 # --- إعداد البوت ---
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-dp = Dispatcher(storage=MemoryStorage())
-user_session_data = {}
+if SESSION_BACKEND == "redis":
+    from aiogram.fsm.storage.redis import RedisStorage
+    dp = Dispatcher(storage=RedisStorage.from_url(REDIS_URL))
+else:
+    dp = Dispatcher(storage=MemoryStorage())
 
 # --- وظائف قاعدة البيانات ---
-async def is_user_paid(pool, user_id: int):
-    res = await pool.fetchval("SELECT 1 FROM paid_users WHERE user_id = $1", user_id)
-    return bool(res)
+class Entitlement:
+    __slots__ = ("lang", "is_paid", "trial_used")
+
+    def __init__(self, lang, is_paid, trial_used):
+        self.lang = lang or "ar"
+        self.is_paid = is_paid
+        self.trial_used = trial_used
+
+    @property
+    def has_trial(self):
+        return not self.trial_used
+
+    @property
+    def has_access(self):
+        return self.is_paid or not self.trial_used
+
+ENTITLEMENT_SQL = "SELECT lang, is_paid, trial_used FROM users_info WHERE user_id = $1"
+
+# كاش الصلاحيات: صف واحد لكل مستخدم (مدفوع، استخدم التجربة، اللغة) مع TTL
+entitlement_cache = OrderedDict()  # user_id -> (expires_at, Entitlement)
+entitlement_stats = {"hits": 0, "misses": 0}
+
+async def get_entitlement(pool, user_id: int):
+    entry = entitlement_cache.get(user_id)
+    if entry is not None and entry[0] >= time.monotonic():
+        entitlement_stats["hits"] += 1
+        entitlement_cache.move_to_end(user_id)
+        return entry[1]
+    entitlement_stats["misses"] += 1
+    row = await pool.fetchrow(ENTITLEMENT_SQL, user_id)
+    ent = Entitlement(row['lang'], row['is_paid'], row['trial_used']) if row else Entitlement(None, False, False)
+    entitlement_cache[user_id] = (time.monotonic() + ENTITLEMENT_TTL, ent)
+    entitlement_cache.move_to_end(user_id)
+    while len(entitlement_cache) > ENTITLEMENT_CACHE_MAX:
+        entitlement_cache.popitem(last=False)
+    return ent
+
+def cached_lang(user_id: int):
+    # لغة المستخدم من الكاش فقط (حتى لو انتهت صلاحيته) لمسارات لا تحتمل استعلاماً
+    entry = entitlement_cache.get(user_id)
+    return entry[1].lang if entry is not None else "ar"
+
+def invalidate_entitlement(user_id: int):
+    # يجب استدعاؤها بعد أي كتابة على is_paid أو trial_used أو lang
+    entitlement_cache.pop(user_id, None)
+
+async def notify_entitlement(conn, user_id: int):
+    # يُرسل عند الـ commit؛ النسخ الأخرى تمسح الكاش عبر entitlement_listener
+    await conn.execute("SELECT pg_notify('entitlement_changed', $1)", str(user_id))
+
+async def entitlement_listener():
+    # في وضع الطابور قد يصل المستخدم لأي عامل، فكل كتابة على الصلاحيات يجب أن تمسح كاش كل النسخ
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener(
+                "entitlement_changed", lambda c, pid, channel, payload: entitlement_cache.pop(int(payload), None)
+            )
+            # أي إشعار ضاع أثناء الانقطاع قد يترك صلاحية قديمة، فنبدأ بكاش فارغ
+            entitlement_cache.clear()
+            while not conn.is_closed():
+                await asyncio.sleep(ENTITLEMENT_TTL / 2)
+                await conn.fetchval("SELECT 1")
+        except Exception as e:
+            print(f"Entitlement listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
+
+async def mark_paid(conn, user_id: int):
+    await conn.execute("""
+        INSERT INTO users_info (user_id, is_paid, paid_at) VALUES ($1, TRUE, now())
+        ON CONFLICT (user_id) DO UPDATE SET is_paid = TRUE, paid_at = COALESCE(users_info.paid_at, now())
+    """, user_id)
+    await notify_entitlement(conn, user_id)
+
+async def mark_trial_used(conn, user_id: int):
+    await conn.execute("""
+        INSERT INTO users_info (user_id, trial_used, trial_used_at) VALUES ($1, TRUE, now())
+        ON CONFLICT (user_id) DO UPDATE SET trial_used = TRUE, trial_used_at = COALESCE(users_info.trial_used_at, now())
+    """, user_id)
+    await notify_entitlement(conn, user_id)
+
+# --- تتبع النشاط اليومي (كتابة مؤجلة ومجمعة بدل upsert مع كل رسالة) ---
+activity_state = {"day": None, "seen": set(), "pending": set()}
+activity_stats = {"skipped": 0, "queued": 0, "flushed": 0}
+
+def track_activity(user_id: int):
+    day = time.strftime("%Y-%m-%d", time.gmtime())
+    if activity_state["day"] != day:
+        activity_state["day"] = day
+        activity_state["seen"] = set()
+    if user_id in activity_state["seen"]:
+        activity_stats["skipped"] += 1
+        return
+    activity_state["seen"].add(user_id)
+    activity_state["pending"].add(user_id)
+    activity_stats["queued"] += 1
+
+async def flush_activity(pool):
+    pending = activity_state["pending"]
+    if not pending:
+        return
+    activity_state["pending"] = set()
+    try:
+        # ترتيب المعرفات يمنع الـ deadlock بين النسخ التي تكتب نفس الصفوف
+        await pool.execute("""
+            INSERT INTO users_info (user_id, last_active)
+            SELECT uid, CURRENT_DATE FROM unnest($1::bigint[]) AS uid
+            ON CONFLICT (user_id) DO UPDATE SET last_active = CURRENT_DATE
+            WHERE users_info.last_active IS DISTINCT FROM CURRENT_DATE
+        """, sorted(pending))
+        activity_stats["flushed"] += len(pending)
+    except Exception as e:
+        activity_state["pending"] |= pending
+        print(f"Activity flush error: {e}")
+
+async def activity_flusher(pool):
+    while True:
+        await asyncio.sleep(ACTIVITY_FLUSH_INTERVAL)
+        await flush_activity(pool)
+
+# --- مخزن الجلسات (بديل user_session_data: مدة صلاحية + حد للذاكرة + خلفيات قابلة للتبديل) ---
+class SessionEntry:
+    __slots__ = ("lang", "sym", "price", "quotes")
+
+    def __init__(self, lang, sym=None, price=None, quotes=None):
+        self.lang = lang
+        self.sym = sym
+        self.price = price
+        self.quotes = quotes
+
+    def to_dict(self):
+        return {"lang": self.lang, "sym": self.sym, "price": self.price, "quotes": self.quotes}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d.get("lang"), d.get("sym"), d.get("price"), d.get("quotes"))
 
-async def has_trial(pool, user_id: int):
-    res = await pool.fetchval("SELECT 1 FROM trial_users WHERE user_id = $1", user_id)
-    return not bool(res)
+class MemorySessionBackend:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # user_id -> (expires_at, SessionEntry)
+
+    def bind(self, pool):
+        pass
+
+    async def get(self, user_id):
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        if item[0] < time.monotonic():
+            del self._data[user_id]
+            return None
+        return item[1]
+
+    async def set(self, user_id, entry):
+        self._data[user_id] = (time.monotonic() + self.ttl, entry)
+        self._data.move_to_end(user_id)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    async def prune(self):
+        now = time.monotonic()
+        for user_id in [u for u, (exp, _) in self._data.items() if exp < now]:
+            del self._data[user_id]
+
+class PostgresSessionBackend:
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.pool = None
+
+    def bind(self, pool):
+        self.pool = pool
+
+    async def get(self, user_id):
+        raw = await self.pool.fetchval("SELECT data FROM user_sessions WHERE user_id = $1 AND expires_at > now()", user_id)
+        return SessionEntry.from_dict(json.loads(raw)) if raw else None
+
+    async def set(self, user_id, entry):
+        await self.pool.execute("""
+            INSERT INTO user_sessions (user_id, data, expires_at) VALUES ($1, $2, now() + make_interval(secs => $3))
+            ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+        """, user_id, json.dumps(entry.to_dict()), self.ttl)
+
+    async def prune(self):
+        await self.pool.execute("DELETE FROM user_sessions WHERE expires_at < now()")
+
+class RedisSessionBackend:
+    """يعمل مع Redis أو أي بديل محلي متوافق مع بروتوكوله."""
+
+    def __init__(self, url, ttl):
+        import redis.asyncio as redis
+        self.client = redis.from_url(url)
+        self.ttl = int(ttl)
+
+    def bind(self, pool):
+        pass
+
+    async def get(self, user_id):
+        raw = await self.client.get(f"session:{user_id}")
+        return SessionEntry.from_dict(json.loads(raw)) if raw else None
+
+    async def set(self, user_id, entry):
+        await self.client.set(f"session:{user_id}", json.dumps(entry.to_dict()), ex=self.ttl)
+
+    async def prune(self):
+        pass  # Redis يحذف المفاتيح المنتهية بنفسه
+
+if SESSION_BACKEND == "postgres":
+    session_store = PostgresSessionBackend(SESSION_TTL)
+elif SESSION_BACKEND == "redis":
+    session_store = RedisSessionBackend(REDIS_URL, SESSION_TTL)
+else:
+    session_store = MemorySessionBackend(SESSION_TTL, SESSION_MAX)
+
+async def session_pruner():
+    while True:
+        await asyncio.sleep(600)
+        try:
+            await session_store.prune()
+        except Exception as e:
+            print(f"Session prune error: {e}")
+
+# --- ترحيلات قاعدة البيانات (بالترتيب، ولا يُعدّل أي ترحيل بعد نشره) ---
+MIGRATIONS = [
+    (1, "baseline", """
+        CREATE TABLE IF NOT EXISTS users_info (user_id BIGINT PRIMARY KEY, lang TEXT);
+        ALTER TABLE users_info ADD COLUMN IF NOT EXISTS last_active DATE;
+        ALTER TABLE users_info ADD COLUMN IF NOT EXISTS blocked BOOLEAN NOT NULL DEFAULT FALSE;
+        CREATE TABLE IF NOT EXISTS paid_users (user_id BIGINT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS trial_users (user_id BIGINT PRIMARY KEY);
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            job_id BIGSERIAL PRIMARY KEY,
+            label TEXT,
+            variants JSONB NOT NULL,
+            parse_mode TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            finished_at TIMESTAMPTZ
+        );
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id BIGINT NOT NULL REFERENCES broadcast_jobs ON DELETE CASCADE,
+            user_id BIGINT NOT NULL,
+            is_paid BOOLEAN NOT NULL,
+            lang TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INT NOT NULL DEFAULT 0,
+            claimed_at TIMESTAMPTZ,
+            sent_at TIMESTAMPTZ,
+            PRIMARY KEY (job_id, user_id)
+        );
+        CREATE INDEX IF NOT EXISTS broadcast_deliveries_open_idx
+            ON broadcast_deliveries (job_id) WHERE status IN ('pending', 'claimed');
+        CREATE TABLE IF NOT EXISTS scheduler_state (name TEXT PRIMARY KEY, next_run_at TIMESTAMPTZ);
+    """),
+    (2, "consolidated_users", """
+        ALTER TABLE users_info
+            ADD COLUMN IF NOT EXISTS is_paid BOOLEAN NOT NULL DEFAULT FALSE,
+            ADD COLUMN IF NOT EXISTS paid_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS trial_used BOOLEAN NOT NULL DEFAULT FALSE,
+            ADD COLUMN IF NOT EXISTS trial_used_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS created_at TIMESTAMPTZ NOT NULL DEFAULT now();
+
+        INSERT INTO users_info (user_id, is_paid) SELECT user_id, TRUE FROM paid_users
+            ON CONFLICT (user_id) DO UPDATE SET is_paid = TRUE;
+        INSERT INTO users_info (user_id, trial_used) SELECT user_id, TRUE FROM trial_users
+            ON CONFLICT (user_id) DO UPDATE SET trial_used = TRUE;
+
+        -- نحتفظ بالجداول القديمة بأسماء جديدة للرجوع إليها عند الحاجة
+        ALTER TABLE paid_users RENAME TO paid_users_legacy;
+        ALTER TABLE trial_users RENAME TO trial_users_legacy;
+
+        CREATE INDEX IF NOT EXISTS users_info_last_active_idx ON users_info (last_active);
+        CREATE INDEX IF NOT EXISTS users_info_paid_idx ON users_info (user_id) WHERE is_paid;
+        CREATE INDEX IF NOT EXISTS users_info_trial_idx ON users_info (user_id) WHERE trial_used;
+        CREATE INDEX IF NOT EXISTS users_info_inactive_idx ON users_info (user_id) WHERE NOT is_paid AND NOT trial_used;
+        CREATE INDEX IF NOT EXISTS broadcast_deliveries_open_user_idx
+            ON broadcast_deliveries (user_id) WHERE status IN ('pending', 'claimed');
+    """),
+    (3, "stats_counters", """
+        -- العدادات مقسمة على 16 صفاً (shard) لتقليل التنافس على قفل صف واحد
+        CREATE TABLE stats_counters (
+            name TEXT NOT NULL,
+            shard SMALLINT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (name, shard)
+        );
+        CREATE TABLE stats_daily (
+            day DATE NOT NULL,
+            metric TEXT NOT NULL,
+            shard SMALLINT NOT NULL,
+            value BIGINT NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric, shard)
+        );
+
+        CREATE FUNCTION bump_stat(p_name TEXT, p_delta BIGINT) RETURNS void AS $$
+            INSERT INTO stats_counters (name, shard, value) VALUES (p_name, floor(random() * 16)::smallint, p_delta)
+            ON CONFLICT (name, shard) DO UPDATE SET value = stats_counters.value + EXCLUDED.value
+        $$ LANGUAGE sql;
+
+        CREATE FUNCTION bump_daily(p_metric TEXT, p_delta BIGINT) RETURNS void AS $$
+            INSERT INTO stats_daily (day, metric, shard, value) VALUES (CURRENT_DATE, p_metric, floor(random() * 16)::smallint, p_delta)
+            ON CONFLICT (day, metric, shard) DO UPDATE SET value = stats_daily.value + EXCLUDED.value
+        $$ LANGUAGE sql;
+
+        CREATE FUNCTION users_info_stats() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM bump_stat('total', 1);
+                PERFORM bump_daily('signups', 1);
+                IF NEW.is_paid THEN PERFORM bump_stat('vips', 1); PERFORM bump_daily('conversions', 1); END IF;
+                IF NEW.trial_used THEN PERFORM bump_stat('trials', 1); PERFORM bump_daily('trials', 1); END IF;
+                IF NEW.last_active = CURRENT_DATE THEN PERFORM bump_daily('active', 1); END IF;
+            ELSIF TG_OP = 'UPDATE' THEN
+                IF NEW.is_paid AND NOT OLD.is_paid THEN PERFORM bump_stat('vips', 1); PERFORM bump_daily('conversions', 1);
+                ELSIF OLD.is_paid AND NOT NEW.is_paid THEN PERFORM bump_stat('vips', -1); END IF;
+                IF NEW.trial_used AND NOT OLD.trial_used THEN PERFORM bump_stat('trials', 1); PERFORM bump_daily('trials', 1);
+                ELSIF OLD.trial_used AND NOT NEW.trial_used THEN PERFORM bump_stat('trials', -1); END IF;
+                IF NEW.last_active = CURRENT_DATE AND OLD.last_active IS DISTINCT FROM CURRENT_DATE THEN
+                    PERFORM bump_daily('active', 1);
+                END IF;
+            ELSE
+                PERFORM bump_stat('total', -1);
+                IF OLD.is_paid THEN PERFORM bump_stat('vips', -1); END IF;
+                IF OLD.trial_used THEN PERFORM bump_stat('trials', -1); END IF;
+            END IF;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql;
+
+        -- تعبئة أولية من الحالة الحالية قبل تفعيل التريغر
+        INSERT INTO stats_counters (name, shard, value)
+            SELECT 'total', 0, count(*) FROM users_info
+            UNION ALL SELECT 'vips', 0, count(*) FROM users_info WHERE is_paid
+            UNION ALL SELECT 'trials', 0, count(*) FROM users_info WHERE trial_used;
+        INSERT INTO stats_daily (day, metric, shard, value)
+            SELECT CURRENT_DATE, 'active', 0, count(*) FROM users_info WHERE last_active = CURRENT_DATE;
+
+        CREATE TRIGGER users_info_stats_trg
+            AFTER INSERT OR UPDATE OF is_paid, trial_used, last_active OR DELETE ON users_info
+            FOR EACH ROW EXECUTE FUNCTION users_info_stats();
+    """),
+    (4, "analysis_cache", """
+        CREATE TABLE analysis_cache (
+            key TEXT PRIMARY KEY,
+            result TEXT NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX analysis_cache_expires_idx ON analysis_cache (expires_at);
+    """),
+    (5, "user_sessions", """
+        CREATE TABLE user_sessions (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        CREATE INDEX user_sessions_expires_idx ON user_sessions (expires_at);
+    """),
+    (6, "update_queue", """
+        CREATE TABLE update_queue (
+            id BIGSERIAL PRIMARY KEY,
+            update_id BIGINT UNIQUE,
+            chat_id BIGINT NOT NULL,
+            payload JSONB NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            claimed_at TIMESTAMPTZ
+        );
+        CREATE INDEX update_queue_chat_idx ON update_queue (chat_id, id);
+    """),
+    (7, "payments", """
+        CREATE TABLE payment_invoices (
+            invoice_id TEXT PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'waiting',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        CREATE INDEX payment_invoices_open_idx ON payment_invoices (created_at) WHERE status = 'waiting';
+        CREATE TABLE payment_events (
+            payment_id BIGINT PRIMARY KEY,
+            invoice_id TEXT,
+            user_id BIGINT NOT NULL,
+            status TEXT NOT NULL,
+            activated BOOLEAN NOT NULL DEFAULT FALSE,
+            notified BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """),
+    (8, "update_queue_received_at", """
+        ALTER TABLE update_queue ADD COLUMN received_at TIMESTAMPTZ NOT NULL DEFAULT now();
+    """),
+    (9, "market_cache", """
+        CREATE TABLE market_cache (
+            name TEXT PRIMARY KEY,
+            version BIGINT NOT NULL,
+            fetched_at TIMESTAMPTZ NOT NULL,
+            data JSONB NOT NULL
+        );
+    """),
+]
+
+async def run_migrations(pool):
+    async with pool.acquire() as conn:
+        # قفل استشاري حتى لا تطبق نسختان من البوت نفس الترحيل في نفس الوقت
+        await conn.execute("SELECT pg_advisory_lock(hashtext('crypto_bot_migrations'))")
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version INT PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            applied = {r['version'] for r in await conn.fetch("SELECT version FROM schema_migrations")}
+            for version, name, sql in MIGRATIONS:
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(sql)
+                    await conn.execute("INSERT INTO schema_migrations (version, name) VALUES ($1, $2)", version, name)
+                print(f"✅ Migration {version} ({name}) applied")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock(hashtext('crypto_bot_migrations'))")
+
+# --- المقاييس (هيستوجرامات بصيغة Prometheus تُعرض على /metrics) ---
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5)
+
+class Histogram:
+    __slots__ = ("name", "help", "buckets", "series")
+
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.series = {}  # labels -> [عداد لكل bucket..., +Inf, sum, count]
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        row = self.series.get(key)
+        if row is None:
+            row = self.series[key] = [0] * (len(self.buckets) + 3)
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-2] += value
+        row[-1] += 1
+
+    def render(self, lines):
+        lines.append(f"# HELP {self.name} {self.help}")
+        lines.append(f"# TYPE {self.name} histogram")
+        for key, row in self.series.items():
+            prefix = "".join(f'{k}="{v}",' for k, v in key)
+            cumulative = 0
+            for le, n in zip((*self.buckets, "+Inf"), row):
+                cumulative += n
+                lines.append(f'{self.name}_bucket{{{prefix}le="{le}"}} {cumulative}')
+            labels = "{" + prefix.rstrip(",") + "}" if prefix else ""
+            lines.append(f"{self.name}_sum{labels} {row[-2]}")
+            lines.append(f"{self.name}_count{labels} {row[-1]}")
+
+webhook_ack_seconds = Histogram("bot_webhook_ack_seconds", "Time to acknowledge a Telegram webhook")
+update_seconds = Histogram("bot_update_seconds", "Webhook receipt to handler completion")
+upstream_seconds = Histogram("bot_upstream_request_seconds", "Upstream API latency until response headers")
+db_query_seconds = Histogram("bot_db_query_seconds", "Postgres query latency")
+db_pool_wait_seconds = Histogram("bot_db_pool_wait_seconds", "Sampled wait to acquire a pooled connection")
+event_loop_lag_seconds = Histogram("bot_event_loop_lag_seconds", "Event loop scheduling delay", LAG_BUCKETS)
+upstream_errors = {}  # (upstream, kind) -> count
+
+def count_upstream_error(upstream, kind):
+    upstream_errors[(upstream, kind)] = upstream_errors.get((upstream, kind), 0) + 1
+
+async def telegram_metrics(make_request, bot, method):
+    # كل طلبات Bot API تمر من هنا عبر جلسة aiogram
+    started = time.perf_counter()
+    try:
+        return await make_request(bot, method)
+    except TelegramAPIError as e:
+        count_upstream_error("telegram", type(e).__name__)
+        raise
+    finally:
+        upstream_seconds.observe(time.perf_counter() - started, upstream="telegram")
+
+bot.session.middleware(telegram_metrics)
+
+def _record_query(query):
+    db_query_seconds.observe(query.elapsed)
+
+async def runtime_monitor(pool):
+    # تأخر حلقة الأحداث كل ثانية، وانتظار اتصال من الـ pool كل عشر عينات
+    tick = 0
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+        event_loop_lag_seconds.observe(max(0.0, time.perf_counter() - started - METRICS_SAMPLE_INTERVAL))
+        tick += 1
+        if tick % 10:
+            continue
+        started = time.perf_counter()
+        try:
+            async with pool.acquire():
+                pass
+            db_pool_wait_seconds.observe(time.perf_counter() - started)
+        except Exception as e:
+            print(f"Pool probe error: {e}")
+
+def _samples(lines, name, kind, help, samples):
+    lines.append(f"# HELP {name} {help}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        label_str = ",".join(f'{k}="{v}"' for k, v in labels.items())
+        lines.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+
+async def render_metrics(pool):
+    lines = []
+    for h in (webhook_ack_seconds, update_seconds, upstream_seconds, db_query_seconds, db_pool_wait_seconds, event_loop_lag_seconds):
+        h.render(lines)
+
+    _samples(lines, "bot_upstream_errors_total", "counter", "Upstream failures by kind",
+             [({"upstream": u, "kind": k}, n) for (u, k), n in upstream_errors.items()])
+    _samples(lines, "bot_http_requests_total", "counter", "Requests sent through the shared HTTP clients",
+             [({"upstream": name}, st["requests"]) for name, st in http_stats.items()])
+    _samples(lines, "bot_http_connection_reuse_total", "counter", "Requests served on a pooled connection",
+             [({"upstream": name}, st["pool_hits"]) for name, st in http_stats.items()])
+    _samples(lines, "bot_http_handshakes_total", "counter", "New TCP connections opened by the shared HTTP clients",
+             [({"upstream": name}, st["handshakes"]) for name, st in http_stats.items()])
+    _samples(lines, "bot_groq_calls_total", "counter", "Groq calls per model",
+             [({"model": m}, st["calls"]) for m, st in groq_gateway.stats.items()])
+    _samples(lines, "bot_groq_errors_total", "counter", "Groq errors per model",
+             [({"model": m}, st["errors"]) for m, st in groq_gateway.stats.items()])
+    _samples(lines, "bot_updates_total", "counter", "Webhook admission decisions",
+             [({"result": k}, v) for k, v in admission_stats.items() if k != "inflight"])
+
+    caches = {"quote": quote_cache.stats, "analysis": analysis_cache.stats, "entitlement": entitlement_stats}
+    _samples(lines, "bot_cache_requests_total", "counter", "Cache lookups by result",
+             [({"cache": c, "result": r}, st.get(r, 0)) for c, st in caches.items() for r in ("hits", "misses")])
+    _samples(lines, "bot_cache_hit_ratio", "gauge", "Cache hit ratio since start",
+             [({"cache": c}, round(st["hits"] / max(1, st["hits"] + st.get("misses", 0)), 4)) for c, st in caches.items()])
+
+    depth = [({"queue": "ingress"}, ingress_queue.qsize()), ({"queue": "inflight"}, admission_stats["inflight"])]
+    if SCALE_MODE == "queue" and pool is not None:
+        depth.append(({"queue": "update_queue"}, await pool.fetchval("SELECT count(*) FROM update_queue")))
+    _samples(lines, "bot_queue_depth", "gauge", "Pending work items", depth)
+    if pool is not None:
+        _samples(lines, "bot_db_pool_connections", "gauge", "Postgres pool connections",
+                 [({"state": "open"}, pool.get_size()), ({"state": "idle"}, pool.get_idle_size())])
+    _samples(lines, "bot_cmc_credits_last_hour", "gauge", "CMC credits spent in the last hour",
+             [({}, market_data.credits_last_hour())])
+    return "\n".join(lines) + "\n"
+
+async def metrics_handler(req: web.Request):
+    return web.Response(text=await render_metrics(req.app.get('db_pool')), content_type="text/plain", charset="utf-8")
+
+background_tasks = {}
+
+def spawn_background(name, coro):
+    background_tasks[name] = asyncio.create_task(coro)
+
+async def health_handler(req: web.Request):
+    # جاهزية حقيقية: الـ pool يرد، وكل الحلقات الخلفية ما زالت تعمل
+    problems = []
+    pool = req.app.get('db_pool')
+    if pool is None:
+        problems.append("db pool not initialised")
+    else:
+        try:
+            await asyncio.wait_for(pool.fetchval("SELECT 1"), timeout=HEALTH_DB_TIMEOUT)
+        except Exception as e:
+            problems.append(f"db: {e!r}")
+    stopped = [name for name, task in background_tasks.items() if task.done()]
+    if stopped:
+        problems.append("stopped loops: " + ", ".join(stopped))
+    if problems:
+        return web.Response(text="\n".join(problems), status=503)
+    return web.Response(text="ok")
+
+# --- طبقة HTTP المشتركة (عميل واحد لكل مزود مع إعادة استخدام الاتصالات) ---
+try:
+    import h2  # noqa: F401  (مطلوب لتفعيل HTTP/2 في httpx)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+UPSTREAMS = {
+    "cmc": {
+        "base_url": "https://pro-api.coinmarketcap.com",
+        "headers": {"X-CMC_PRO_API_KEY": CMC_KEY or ""},
+        "timeout": HTTP_TIMEOUT_CMC,
+        "max_concurrency": HTTP_MAX_CONCURRENCY_CMC,
+        "http2": True,
+    },
+    "groq": {
+        "base_url": "https://api.groq.com",
+        "headers": {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"},
+        "timeout": HTTP_TIMEOUT_GROQ,
+        "max_concurrency": HTTP_MAX_CONCURRENCY_GROQ,
+        "http2": True,
+    },
+    "binance": {
+        "base_url": "https://api.binance.com",
+        "headers": {},
+        "timeout": HTTP_TIMEOUT_CMC,
+        "max_concurrency": HTTP_MAX_CONCURRENCY_CMC,
+        "http2": True,
+    },
+    "nowpayments": {
+        "base_url": "https://api.nowpayments.io",
+        "headers": {"x-api-key": NOWPAYMENTS_API_KEY or "", "Content-Type": "application/json"},
+        "timeout": HTTP_TIMEOUT_NOWPAYMENTS,
+        "max_concurrency": HTTP_MAX_CONCURRENCY_NOWPAYMENTS,
+        "http2": False,
+    },
+}
+
+http_clients = {}
+http_limits = {}
+http_stats = {name: {"requests": 0, "pool_hits": 0, "handshakes": 0, "errors": 0} for name in UPSTREAMS}
+
+def _http_hooks(name):
+    stats = http_stats[name]
+
+    async def on_request(request):
+        stats["requests"] += 1
+        request.extensions = {**request.extensions, "started": time.perf_counter()}
+
+        # نتتبع فتح اتصال TCP جديد لهذا الطلب لنميز بين إعادة الاستخدام والمصافحة الكاملة
+        async def trace(event, info):
+            if event == "connection.connect_tcp.complete":
+                trace.connected = True
+                stats["handshakes"] += 1
+        trace.connected = False
+        request.extensions = {**request.extensions, "trace": trace}
+
+    async def on_response(response):
+        started = response.request.extensions.get("started")
+        if started is not None:
+            upstream_seconds.observe(time.perf_counter() - started, upstream=name)
+        if response.status_code >= 400:
+            count_upstream_error(name, str(response.status_code))
+        trace = response.request.extensions.get("trace")
+        if trace is not None and not getattr(trace, "connected", True):
+            stats["pool_hits"] += 1
+
+    return {"request": [on_request], "response": [on_response]}
+
+async def open_http_clients():
+    for name, cfg in UPSTREAMS.items():
+        if name in http_clients:
+            continue
+        http_clients[name] = httpx.AsyncClient(
+            base_url=cfg["base_url"],
+            headers=cfg["headers"],
+            timeout=httpx.Timeout(cfg["timeout"], connect=min(cfg["timeout"], 10)),
+            limits=httpx.Limits(
+                max_connections=cfg["max_concurrency"],
+                max_keepalive_connections=cfg["max_concurrency"],
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            http2=cfg["http2"] and HTTP2_AVAILABLE,
+            event_hooks=_http_hooks(name),
+        )
+        http_limits[name] = asyncio.Semaphore(cfg["max_concurrency"])
+
+async def close_http_clients(app=None):
+    for name in list(http_clients):
+        await http_clients.pop(name).aclose()
+
+def count_transport_error(name, e):
+    http_stats[name]["errors"] += 1
+    count_upstream_error(name, type(e).__name__)
+
+async def upstream_request(name, method, url, **kwargs):
+    """طلب عبر العميل المشترك للمزود `name` مع احترام حد التزامن الخاص به."""
+    if name not in http_clients:
+        await open_http_clients()
+    async with http_limits[name]:
+        try:
+            return await http_clients[name].request(method, url, **kwargs)
+        except httpx.HTTPError as e:
+            count_transport_error(name, e)
+            raise
+
+# --- كاش عام (TTL + LRU + دمج الطلبات المتزامنة لنفس المفتاح) ---
+class TTLCache:
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._data = OrderedDict()  # sym -> (expires_at, coin)
+        self._inflight = {}
+        self.stats = {"hits": 0, "misses": 0, "stale": 0, "coalesced": 0}
+
+    def put(self, sym, coin, ttl=None):
+        self._data[sym] = (time.monotonic() + (ttl or self.ttl), coin)
+        self._data.move_to_end(sym)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def peek(self, sym):
+        entry = self._data.get(sym)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            return None
+        self._data.move_to_end(sym)
+        return entry[1]
+
+    async def get(self, sym, fetch, ttl=None):
+        entry = self._data.get(sym)
+        if entry is not None:
+            if entry[0] >= time.monotonic():
+                self.stats["hits"] += 1
+                self._data.move_to_end(sym)
+                return entry[1]
+            self.stats["stale"] += 1
+        else:
+            self.stats["misses"] += 1
+
+        # إذا كان هناك طلب جارٍ لنفس الرمز ننتظر نتيجته بدل إرسال طلب جديد
+        fut = self._inflight.get(sym)
+        if fut is not None:
+            self.stats["coalesced"] += 1
+            return await asyncio.shield(fut)
+
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[sym] = fut
+        try:
+            coin = await fetch()
+            if coin is not None:
+                self.put(sym, coin, ttl)
+            fut.set_result(coin)
+            return coin
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()  # تجنب تحذير "exception was never retrieved" إن لم ينتظرها أحد
+            raise
+        finally:
+            # إلغاء الطلب القائد (CancelledError) لا يمر عبر except أعلاه، فنحرر المنتظرين هنا حتى لا يعلقوا
+            if not fut.done():
+                fut.set_exception(RuntimeError(f"fetch for {sym} was cancelled"))
+                fut.exception()
+            self._inflight.pop(sym, None)
+
+quote_cache = TTLCache(QUOTE_CACHE_TTL, QUOTE_CACHE_MAX)
+
+async def fetch_quotes_bulk(symbols):
+    """طلب واحد لعدة رموز مفصولة بفواصل. يعيد dict: sym -> coin للرموز الموجودة فقط."""
+    res = await upstream_request(
+        "cmc", "GET", "/v1/cryptocurrency/quotes/latest",
+        params={"symbol": ",".join(symbols), "skip_invalid": "true"}
+    )
+    data = res.json()
+    market_data.record_credits(data)
+    if res.status_code == 200 and "data" in data:
+        return {sym: data["data"][sym] for sym in symbols if sym in data["data"]}
+    if res.status_code != 400:
+        # 429/5xx/401: تقسيم الدفعة هنا يضاعف الحمل على CMC في أسوأ وقت، فتفشل الدفعة كاملة
+        raise RuntimeError(f"quotes/latest HTTP {res.status_code}")
+    if len(symbols) == 1:
+        return {}
+    # إذا رفض CMC الدفعة كاملة بسبب رمز غير صالح نعيد المحاولة لكل رمز على حدة
+    found = {}
+    for part in await asyncio.gather(*(fetch_quotes_bulk([sym]) for sym in symbols), return_exceptions=True):
+        if isinstance(part, dict):
+            found.update(part)
+    return found
+
+# --- تجميع طلبات الأسعار من كل المستخدمين خلال نافذة زمنية قصيرة في طلب واحد ---
+class QuoteBatcher:
+    def __init__(self, window, max_batch):
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = {}  # sym -> future
+        self._timer = None
+        self._tasks = set()
+        self.stats = {"batches": 0, "symbols": 0}
+
+    async def load(self, sym):
+        fut = self._pending.get(sym)
+        if fut is None:
+            loop = asyncio.get_running_loop()
+            fut = loop.create_future()
+            self._pending[sym] = fut
+            if len(self._pending) >= self.max_batch:
+                self._flush()
+            elif self._timer is None:
+                self._timer = loop.call_later(self.window, self._flush)
+        return await asyncio.shield(fut)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, {}
+        if batch:
+            task = asyncio.create_task(self._run(batch))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        self.stats["batches"] += 1
+        self.stats["symbols"] += len(batch)
+        try:
+            found = await fetch_quotes_bulk(list(batch))
+        except Exception as e:
+            for fut in batch.values():
+                if not fut.done():
+                    fut.set_exception(e)
+                    fut.exception()
+            return
+        for sym, fut in batch.items():
+            if not fut.done():
+                fut.set_result(found.get(sym))
+
+quote_batcher = QuoteBatcher(QUOTE_BATCH_WINDOW, QUOTE_BATCH_MAX)
+
+async def fetch_quote(sym):
+    """يعيد بيانات العملة من CMC (نفس شكل عناصر quotes/latest) أو None إذا كان الرمز غير موجود."""
+    # العملات ضمن لقطة السوق المشتركة تُقرأ مباشرة بدون أي طلب شبكة
+    coin = market_data.quote(sym)
+    if coin is not None:
+        return coin
+    return await quote_cache.get(sym, lambda: quote_batcher.load(sym))
+
+# --- فهرس الرموز المحلي (تحقق فوري من الرموز واقتراحات بدون أي طلب شبكة) ---
+def _alias_key(text):
+    return re.sub(r"[\s\-_.]+", "", text).upper()
+
+def _edit_distance(a, b, max_dist):
+    # Levenshtein مع توقف مبكر عند تجاوز الحد المسموح
+    if abs(len(a) - len(b)) > max_dist:
+        return max_dist + 1
+    prev = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        cur = [i]
+        for j, cb in enumerate(b, 1):
+            cur.append(min(prev[j] + 1, cur[j - 1] + 1, prev[j - 1] + (ca != cb)))
+        if min(cur) > max_dist:
+            return max_dist + 1
+        prev = cur
+    return prev[-1]
+
+SUGGEST_MAX_DIST = 2
+
+def _deletes(word, max_dist):
+    # كل النصوص الناتجة عن حذف حتى max_dist حروف (أساس SymSpell)
+    out, frontier = {word}, {word}
+    for _ in range(max_dist):
+        frontier = {w[:i] + w[i + 1:] for w in frontier for i in range(len(w))}
+        out |= frontier
+    return out
+
+class SymbolIndex:
+    __slots__ = ("_rank", "_sorted", "_neighbours", "_aliases")
+
+    def __init__(self, entries=()):
+        # entries: (symbol, name, slug, rank) كما في cryptocurrency/map
+        rank, aliases = {}, {}
+        for sym, name, slug, r in entries:
+            sym = sym.upper()
+            r = r if r else 10**9
+            if r < rank.get(sym, 10**9 + 1):
+                rank[sym] = r
+            for alias in (name, slug):
+                key = _alias_key(alias or "")
+                if key and key not in rank and (key not in aliases or r < rank.get(aliases[key], 10**9)):
+                    aliases[key] = sym
+        self._rank = rank
+        self._sorted = tuple(sorted(rank))
+        # رمزان بينهما مسافة تحرير <= 2 يشتركان حتماً في نص ناتج عن حذف حرفين على الأكثر من كل منهما،
+        # فيُبنى هذا الجدول مرة واحدة ويصبح الاقتراح بحثاً في قاموس بدل المرور على كل الرموز.
+        # مقسم حسب طول الرمز حتى لا تجر المدخلات القصيرة (حرف أو حرفان) كل الرموز القصيرة معها
+        neighbours = {}
+        for sym in self._sorted:
+            by_key = neighbours.setdefault(len(sym), {})
+            for key in _deletes(sym, SUGGEST_MAX_DIST):
+                by_key.setdefault(key, []).append(sym)
+        self._neighbours = {n: {k: tuple(v) for k, v in by_key.items()} for n, by_key in neighbours.items()}
+        # الاسم/الـ slug لا يطغى على رمز حقيقي بنفس النص
+        self._aliases = {k: v for k, v in aliases.items() if k not in rank}
+
+    def __len__(self):
+        return len(self._rank)
+
+    def __contains__(self, sym):
+        return sym in self._rank
+
+    def resolve(self, token):
+        """يعيد الرمز الرسمي لرمز أو اسم أو slug، أو None إذا لم يكن معروفاً."""
+        if token in self._rank:
+            return token
+        return self._aliases.get(_alias_key(token))
+
+    def suggest(self, token, limit=3):
+        token = token.upper()
+        scored = {}
+        # مطابقة البادئة عبر البحث الثنائي في القائمة المرتبة
+        i = bisect.bisect_left(self._sorted, token)
+        while i < len(self._sorted) and self._sorted[i].startswith(token) and len(scored) < 50:
+            scored[self._sorted[i]] = (1, self._rank[self._sorted[i]])
+            i += 1
+        max_dist = 1 if len(token) < 5 else SUGGEST_MAX_DIST
+        candidates = set()
+        for key in _deletes(token, max_dist):
+            # الرمز يصل إلى key بحذف max_dist حروف على الأكثر، وطوله لا يبعد عن المدخل أكثر من max_dist
+            for n in range(max(len(key), len(token) - max_dist), min(len(key), len(token)) + max_dist + 1):
+                candidates.update(self._neighbours.get(n, {}).get(key, ()))
+        for sym in candidates:
+            d = _edit_distance(token, sym, max_dist)
+            if d <= max_dist and (sym not in scored or d < scored[sym][0]):
+                scored[sym] = (d, self._rank[sym])
+        return [sym for sym, _ in sorted(scored.items(), key=lambda kv: kv[1])[:limit]]
+
+    def to_snapshot(self):
+        alias_by_sym = {}
+        for key, sym in self._aliases.items():
+            alias_by_sym.setdefault(sym, []).append(key)
+        return [[sym, alias_by_sym.get(sym, []), r] for sym, r in self._rank.items()]
+
+    @classmethod
+    def from_snapshot(cls, rows):
+        return cls((sym, alias, None, r) for sym, aliases, r in rows for alias in (aliases or [None]))
+
+symbol_index = SymbolIndex()
+
+symbol_index_version = 0
+
+def load_symbol_snapshot():
+    global symbol_index
+    try:
+        with open(SYMBOL_SNAPSHOT_PATH, encoding="utf-8") as f:
+            symbol_index = SymbolIndex.from_snapshot(json.load(f))
+        print(f"✅ Symbol index loaded from snapshot ({len(symbol_index)} symbols)")
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        print(f"Symbol snapshot error: {e}")
+
+async def refresh_symbol_index(pool):
+    # تعمل على القائد فقط؛ باقي النسخ تأخذ الفهرس من market_cache عبر follow_shared_market_data
+    global symbol_index, symbol_index_version
+    age = await shared_age(pool, "symbols")
+    if age is not None and age < SYMBOL_INDEX_REFRESH:
+        await asyncio.sleep(SYMBOL_INDEX_REFRESH - age)
+    while True:
+        try:
+            res = await upstream_request("cmc", "GET", "/v1/cryptocurrency/map", params={"listing_status": "active"})
+            body = res.json()
+            market_data.record_credits(body)
+            if res.status_code == 200:
+                rows = body["data"]
+                # بناء جدول الاقتراحات يأخذ جزءاً من الثانية، فيتم خارج حلقة الأحداث
+                symbol_index = await asyncio.to_thread(
+                    SymbolIndex, [(c["symbol"], c.get("name"), c.get("slug"), c.get("rank")) for c in rows]
+                )
+                symbol_index_version = await publish_shared(pool, "symbols", symbol_index.to_snapshot())
+                try:
+                    # نكتب لملف مؤقت ثم نستبدله دفعة واحدة حتى لا يقرأ تشغيل متزامن ملفاً نصف مكتوب
+                    tmp_path = f"{SYMBOL_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+                    with open(tmp_path, "w", encoding="utf-8") as f:
+                        json.dump(symbol_index.to_snapshot(), f, separators=(",", ":"))
+                    os.replace(tmp_path, SYMBOL_SNAPSHOT_PATH)
+                except OSError as e:
+                    print(f"Could not write symbol snapshot: {e}")
+        except Exception as e:
+            print(f"Symbol index error: {e}")
+        await asyncio.sleep(SYMBOL_INDEX_REFRESH)
+
+def invalid_symbol_text(sym, lang):
+    text = i18n.text("invalid_symbol", lang, sym=sym)
+    suggestions = symbol_index.suggest(sym) if len(symbol_index) else []
+    if suggestions:
+        text += i18n.text("did_you_mean", lang, suggestions=", ".join(f"`{s}`" for s in suggestions))
+    return text
+
+def parse_symbols(text):
+    # يقبل رموزاً متعددة مفصولة بمسافات أو فواصل، مع إزالة التكرار والحفاظ على الترتيب
+    syms = [t.lstrip("#$").upper() for t in re.split(r"[\s,،]+", text.strip()) if t.lstrip("#$")]
+    return list(dict.fromkeys(syms))[:MAX_SYMBOLS_PER_MESSAGE]
+
+# --- خدمة بيانات السوق المشتركة (استطلاع واحد لـ CMC يغذي كل المستهلكين) ---
+# كل النسخ تتشارك نفس البيانات عبر جدول market_cache: القائد وحده يستهلك رصيد CMC ويكتب، والباقي يقرأ
+async def publish_shared(pool, name, data):
+    return await pool.fetchval("""
+        INSERT INTO market_cache (name, version, fetched_at, data) VALUES ($1, 1, now(), $2)
+        ON CONFLICT (name) DO UPDATE SET version = market_cache.version + 1, fetched_at = now(), data = EXCLUDED.data
+        RETURNING version
+    """, name, json.dumps(data, separators=(",", ":")))
+
+async def fetch_shared(pool, name, after_version):
+    return await pool.fetchrow(
+        "SELECT version, extract(epoch FROM fetched_at)::float8 AS fetched_at, data FROM market_cache WHERE name = $1 AND version > $2",
+        name, after_version
+    )
+
+async def shared_age(pool, name):
+    return await pool.fetchval("SELECT extract(epoch FROM now() - fetched_at)::float8 FROM market_cache WHERE name = $1", name)
+
+class MarketSnapshot:
+    __slots__ = ("version", "fetched_at", "coins", "by_symbol")
+
+    def __init__(self, version, fetched_at, coins, by_symbol):
+        self.version = version
+        self.fetched_at = fetched_at
+        self.coins = coins
+        self.by_symbol = by_symbol
+
+    @property
+    def age(self):
+        return time.time() - self.fetched_at
+
+class MarketDataService:
+    def __init__(self):
+        self.snapshot = MarketSnapshot(0, 0.0, [], {})
+        self.ready = asyncio.Event()
+        self._subscribers = []
+        self._credits = deque()  # (timestamp, credits)
+        self.stats = {"polls": 0, "errors": 0, "quote_hits": 0}
+
+    def subscribe(self, callback):
+        """callback(snapshot) تُستدعى بعد كل تحديث ناجح."""
+        self._subscribers.append(callback)
+
+    def record_credits(self, body):
+        credits = ((body or {}).get("status") or {}).get("credit_count") or 0
+        if credits:
+            self._credits.append((time.time(), credits))
+
+    def credits_last_hour(self):
+        cutoff = time.time() - 3600
+        while self._credits and self._credits[0][0] < cutoff:
+            self._credits.popleft()
+        return sum(c for _, c in self._credits)
+
+    def poll_interval(self):
+        # listings/latest يكلف رصيداً لكل 200 عملة؛ نبطئ الاستطلاع إذا تجاوز الميزانية الساعية
+        per_poll = math.ceil(MARKET_UNIVERSE / 200)
+        return max(MARKET_POLL_INTERVAL, 3600 * per_poll / MARKET_CREDIT_BUDGET_HOURLY)
+
+    def quote(self, sym):
+        snap = self.snapshot
+        if snap.version and snap.age <= MARKET_MAX_AGE:
+            coin = snap.by_symbol.get(sym)
+            if coin is not None:
+                self.stats["quote_hits"] += 1
+            return coin
+        return None
+
+    async def refresh(self, pool):
+        res = await upstream_request("cmc", "GET", "/v1/cryptocurrency/listings/latest", params={"limit": str(MARKET_UNIVERSE)})
+        body = res.json()
+        self.record_credits(body)
+        if res.status_code != 200:
+            raise RuntimeError(f"listings/latest HTTP {res.status_code}")
+        coins = body["data"]
+        self.apply(await publish_shared(pool, "listings", coins), time.time(), coins)
+
+    def apply(self, version, fetched_at, coins):
+        if version <= self.snapshot.version:
+            return
+        by_symbol = {}
+        for coin in coins:
+            # القائمة مرتبة حسب القيمة السوقية، فنحتفظ بأول عملة لكل رمز مكرر
+            by_symbol.setdefault(coin["symbol"].upper(), coin)
+        self.snapshot = MarketSnapshot(version, fetched_at, coins, by_symbol)
+        self.stats["polls"] += 1
+        self.ready.set()
+        for callback in self._subscribers:
+            try:
+                callback(self.snapshot)
+            except Exception as e:
+                print(f"Market data subscriber error: {e}")
+
+    async def run(self, pool):
+        # تعمل على القائد فقط، فالميزانية الساعية لرصيد CMC تبقى واحدة مهما زاد عدد النسخ
+        age = await shared_age(pool, "listings")
+        if age is not None and age < self.poll_interval():
+            await asyncio.sleep(self.poll_interval() - age)
+        while True:
+            try:
+                await self.refresh(pool)
+            except Exception as e:
+                self.stats["errors"] += 1
+                print(f"Market data error: {e}")
+            await asyncio.sleep(self.poll_interval())
+
+market_data = MarketDataService()
+
+async def follow_shared_market_data(pool):
+    global symbol_index, symbol_index_version
+    while True:
+        try:
+            row = await fetch_shared(pool, "listings", market_data.snapshot.version)
+            if row is not None:
+                market_data.apply(row['version'], row['fetched_at'], json_loads(row['data']))
+            row = await fetch_shared(pool, "symbols", symbol_index_version)
+            if row is not None:
+                symbol_index = await asyncio.to_thread(SymbolIndex.from_snapshot, json_loads(row['data']))
+                symbol_index_version = row['version']
+        except Exception as e:
+            print(f"Market data follow error: {e}")
+        await asyncio.sleep(MARKET_FOLLOW_INTERVAL)
+
+# --- كتالوج الترجمة (نصوص ولوحات مفاتيح جاهزة لكل لغة، تُبنى مرة واحدة عند التشغيل) ---
+# لإضافة لغة جديدة: أضف قاموساً هنا فقط؛ أي مفتاح ناقص يأخذ النص الإنجليزي
+MESSAGES = {
+    "ar": {
+        "lang_name": "Arabic",
+        "lang_button": "🇸🇦 العربية",
+        "choose_language": "👋 أهلاً بك، يرجى اختيار لغتك:",
+        "welcome_paid": "✅ أهلاً بك مجدداً! اشتراكك مفعل.\nأرسل رمز العملة للتحليل.",
+        "welcome_trial": "🎁 لديك تجربة مجانية واحدة! أرسل رمز العملة للتحليل.",
+        "trial_ended": "⚠️ انتهت تجربتك المجانية. للوصول الكامل، يرجى الاشتراك مقابل 10 USDT أو 500 ⭐ لمرة واحدة.",
+        "trial_ended_short": "⚠️ انتهت تجربتك المجانية.",
+        "invalid_symbol": "❌ الرمز `{sym}` غير صحيح. تأكد من كتابة الرمز بشكل صحيح (مثل BTC أو ETH).",
+        "did_you_mean": "\n💡 هل تقصد: {suggestions}",
+        "no_valid_symbols": "❌ لم يتم العثور على أي رمز صحيح (مثل BTC أو ETH).",
+        "invalid_symbols": "❌ رموز غير صحيحة: {symbols}",
+        "select_coin": "⏳ اختر العملة للتحليل:",
+        "fetching_price": "⏳ جاري جلب السعر...",
+        "symbol_selected": "✅ العملة: {sym}\n💵 السعر: ${price:.6f}\n⏳ اختر الإطار الزمني للتحليل:",
+        "tf_weekly": "أسبوعي",
+        "tf_daily": "يومي",
+        "tf_4h": "4 ساعات",
+        "analysis_in_progress": "⏳ جاري التحليل...",
+        "slow_down": "⏳ طلبات كثيرة، يرجى المحاولة بعد لحظات.",
+        "analyzing": "🤖 جاري التحليل...",
+        "btn_pay_crypto": "💎 اشترك الآن (10 USDT مدى الحياة)",
+        "btn_pay_stars": " اشترك الآن بـ 500 نجمة مدى الحياة⭐",
+        "btn_pay_now": "💳 ادفع الآن",
+        "stars_label": "اشتراك البوت بـ 500 نجمة مدى الحياة ⭐",
+        "stars_title": "اشتراك VIP",
+        "stars_description": "اشترك الآن باستخدام 500 ⭐ للوصول الكامل",
+        "payment_link_pending": "⏳ يتم إنشاء رابط الدفع، يرجى الانتظار...",
+        "payment_link_created": "✅ تم إنشاء رابط الدفع.\nلإتمام الاشتراك، ادفع عبر الرابط أدناه.\n\nUSDT (BEP20)",
+        "error_try_later": "❌ حدث خطأ. يرجى المحاولة مرة أخرى لاحقاً.",
+        "payment_confirmed": "✅ تم تأكيد الدفع بنجاح! شكراً لاشتراكك. يمكنك الآن استخدام البوت بشكل كامل.",
+        "radar_vip": ("🚨 **VIP BREAKOUT ALERT**\n\n"
+                      "💎 **العملة:** #{symbol}\n"
+                      "💵 **السعر:** `${price}`\n"
+                      "📈 **الرؤية:**\n{insight}"),
+        "radar_free": ("📡 **رادار الفرص الذكي**\n"
+                       "───────────────────\n"
+                       "🔥 **تم رصد انفجار سعري محتمل الآن!**\n\n"
+                       "📊 **العملة:** `•••••` 🔒\n"
+                       "💰 **السعر الحالي:** `${price}`\n"
+                       "📈 **تلميح تقني:**\n_{insight}_\n\n"
+                       "📢 **اشترك الآن لكشف اسم العملة والأهداف!**"),
+    },
+    "en": {
+        "lang_name": "English",
+        "lang_button": "🇺🇸 English",
+        "choose_language": "Welcome, please choose your language:",
+        "welcome_paid": "✅ Welcome back! Your subscription is active.\nSend a coin symbol to analyze.",
+        "welcome_trial": "🎁 You have one free trial! Send a coin symbol for analysis.",
+        "trial_ended": "⚠️ Your free trial has ended. For full access, please subscribe for a one-time fee of 10 USDT or 500 ⭐.",
+        "trial_ended_short": "⚠️ Trial ended.",
+        "invalid_symbol": "❌ Symbol `{sym}` is invalid. Please check the ticker (e.g., BTC, ETH).",
+        "did_you_mean": "\n💡 Did you mean: {suggestions}",
+        "no_valid_symbols": "❌ None of these symbols are valid (e.g., BTC, ETH).",
+        "invalid_symbols": "❌ Invalid symbols: {symbols}",
+        "select_coin": "⏳ Select a coin to analyze:",
+        "fetching_price": "⏳ Fetching price...",
+        "symbol_selected": "✅ Symbol: {sym}\n💵 Price: ${price:.6f}\n⏳ Select timeframe for analysis:",
+        "tf_weekly": "Weekly",
+        "tf_daily": "Daily",
+        "tf_4h": "4H",
+        "analysis_in_progress": "⏳ Analysis in progress...",
+        "slow_down": "⏳ Too many requests, please try again in a moment.",
+        "analyzing": "🤖 Analyzing...",
+        "btn_pay_crypto": "💎 Subscribe Now (10 USDT Lifetime)",
+        "btn_pay_stars": "⭐ Subscribe Now with 500 Stars Lifetime",
+        "btn_pay_now": "💳 Pay Now",
+        "stars_label": "Subscribe Now with 500 ⭐ Lifetime",
+        "stars_title": "VIP Subscription",
+        "stars_description": "Subscribe Now with 500 ⭐ for full access",
+        "payment_link_pending": "⏳ Generating payment link, please wait...",
+        "payment_link_created": "✅ Payment link created.\nTo complete your subscription, pay via the link below.\n\nUSDT (BEP20)",
+        "error_try_later": "❌ An error occurred. Please try again later.",
+        "payment_confirmed": "✅ Payment confirmed! Thank you for subscribing. You can now use the bot fully.",
+        "radar_vip": ("🚨 **VIP BREAKOUT ALERT**\n\n"
+                      "💎 **Coin:** #{symbol}\n"
+                      "💵 **Price:** `${price}`\n"
+                      "📈 **Insight:**\n{insight}"),
+        "radar_free": ("📡 **SMART RADAR ALERT**\n"
+                       "───────────────────\n"
+                       "🔥 **Potential Breakout Detected!**\n\n"
+                       "📊 **Symbol:** `•••••` 🔒\n"
+                       "💰 **Price:** `${price}`\n"
+                       "📈 **Technical Hint:**\n_{insight}_\n\n"
+                       "📢 **Subscribe VIP to unlock the symbol!**"),
+    },
+}
+
+class Catalog:
+    """نصوص ولوحات مفاتيح لكل لغة تُبنى مرة واحدة؛ لوحات aiogram غير قابلة للتعديل فتُشارك بأمان بين كل الرسائل."""
+
+    def __init__(self, messages, default="en"):
+        self.default = default
+        self.langs = tuple(messages)
+        self._text = {lang: {**messages[default], **m} for lang, m in messages.items()}
+        self._kb = {lang: self._build_keyboards(self._text[lang]) for lang in self.langs}
+        self.language_kb = InlineKeyboardMarkup(inline_keyboard=[[
+            InlineKeyboardButton(text=self._text[l]["lang_button"], callback_data=f"lang_{l}") for l in self.langs
+        ]])
+        self.choose_language = "\n".join(self._text[l]["choose_language"] for l in self.langs)
+
+    @staticmethod
+    def _build_keyboards(t):
+        return {
+            "payment": InlineKeyboardMarkup(inline_keyboard=[
+                [InlineKeyboardButton(text=t["btn_pay_crypto"], callback_data="pay_crypto")],
+                [InlineKeyboardButton(text=t["btn_pay_stars"], callback_data="pay_stars")],
+            ]),
+            "timeframe": InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text=t["tf_weekly"], callback_data="tf_weekly"),
+                InlineKeyboardButton(text=t["tf_daily"], callback_data="tf_daily"),
+                InlineKeyboardButton(text=t["tf_4h"], callback_data="tf_4h"),
+            ]]),
+        }
+
+    def text(self, key, lang, **params):
+        template = self._text.get(lang, self._text[self.default])[key]
+        return template.format(**params) if params else template
+
+    def kb(self, name, lang):
+        return self._kb.get(lang, self._kb[self.default])[name]
+
+i18n = Catalog(MESSAGES)
 
 # --- دوال المساعدة والدفع ---
-async def create_nowpayments_invoice(user_id: int):
-    url = "https://api.nowpayments.io/v1/invoice"
-    headers = {"x-api-key": NOWPAYMENTS_API_KEY, "Content-Type": "application/json"}
+async def create_nowpayments_invoice(pool, user_id: int):
     data = {
         "price_amount": 10,
         "price_currency": "usd",
@@ -60,203 +1401,774 @@ async def create_nowpayments_invoice(user_id: int):
         "success_url": f"https://t.me/{(await bot.get_me()).username}",
     }
     try:
-        async with httpx.AsyncClient() as client:
-            res = await client.post(url, headers=headers, json=data)
-            return res.json().get("invoice_url")
+        res = await upstream_request("nowpayments", "POST", "/v1/invoice", json=data)
+        invoice = res.json()
+        # نسجل الفاتورة حتى تلتقطها المطابقة إن لم يصل إشعار الدفع أبداً
+        if invoice.get("id"):
+            await pool.execute(
+                "INSERT INTO payment_invoices (invoice_id, user_id) VALUES ($1, $2) ON CONFLICT DO NOTHING",
+                str(invoice["id"]), user_id
+            )
+        return invoice.get("invoice_url")
     except: return None
 
 async def send_stars_invoice(chat_id: int, lang="ar"):
-    prices = [LabeledPrice(label="اشتراك البوت بـ 500 نجمة مدى الحياة ⭐" if lang=="ar" else "Subscribe Now with 500 ⭐ Lifetime", amount=500)]
+    prices = [LabeledPrice(label=i18n.text("stars_label", lang), amount=500)]
     await bot.send_invoice(
         chat_id=chat_id,
-        title="اشتراك VIP" if lang=="ar" else "VIP Subscription",
-        description="اشترك الآن باستخدام 500 ⭐ للوصول الكامل" if lang=="ar" else "Subscribe Now with 500 ⭐ for full access",
+        title=i18n.text("stars_title", lang),
+        description=i18n.text("stars_description", lang),
         payload="stars_pay",
         provider_token="", 
         currency="XTR",
         prices=prices
     )
 
-def get_payment_kb(lang):
-    if lang == "ar":
-        return InlineKeyboardMarkup(inline_keyboard=[
-            [InlineKeyboardButton(text="💎 اشترك الآن (10 USDT مدى الحياة)", callback_data="pay_crypto")],
-            [InlineKeyboardButton(text=" اشترك الآن بـ 500 نجمة مدى الحياة⭐", callback_data="pay_stars")]
-        ])
-    return InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="💎 Subscribe Now (10 USDT Lifetime)", callback_data="pay_crypto")],
-        [InlineKeyboardButton(text="⭐ Subscribe Now with 500 Stars Lifetime", callback_data="pay_stars")]
-    ])
+# --- محرك البث الجماعي ---
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+
+    def pause(self, seconds):
+        # عند RetryAfter يتوقف كل العمال معاً حتى تنتهي المهلة
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            if now < self._paused_until:
+                await asyncio.sleep(self._paused_until - now)
+                continue
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+BROADCAST_AUDIENCE_SQL = """
+    SELECT user_id, COALESCE(lang, 'ar') AS lang, is_paid
+    FROM users_info
+    WHERE NOT blocked
+"""
+
+broadcast_stats = {}
+broadcast_bucket = TokenBucket(BROADCAST_RATE)
+
+async def send_with_retry(chat_id, text, bucket, **kwargs):
+    """يعيد "sent" أو "blocked" أو "failed"."""
+    for attempt in range(BROADCAST_MAX_RETRIES + 1):
+        await bucket.acquire()
+        try:
+            await bot.send_message(chat_id, text, **kwargs)
+            return "sent"
+        except TelegramRetryAfter as e:
+            bucket.pause(e.retry_after)
+        except TelegramForbiddenError:
+            return "blocked"
+        except TelegramBadRequest as e:
+            return "blocked" if "chat not found" in str(e).lower() else "failed"
+        except (TelegramNetworkError, TelegramServerError, asyncio.TimeoutError):
+            await asyncio.sleep(min(2 ** attempt, 30) + random.random())
+        except Exception as e:
+            print(f"Broadcast send error for {chat_id}: {e}")
+            return "failed"
+    return "failed"
+
+async def broadcast(pool, render, label="broadcast", parse_mode=None):
+    """
+    ينشئ مهمة بث دائمة في قاعدة البيانات ويعيد رقمها؛ الإرسال الفعلي يتم في process_broadcast_jobs.
+    render(is_paid, lang) -> (text, reply_markup) ويُستدعى مرة واحدة فقط لكل (is_paid, lang).
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            langs = [r['lang'] for r in await conn.fetch(f"SELECT DISTINCT lang FROM ({BROADCAST_AUDIENCE_SQL}) a")]
+            variants = {}
+            for is_paid in (True, False):
+                for lang in langs:
+                    text, kb = render(is_paid, lang)
+                    variants[f"{int(is_paid)}:{lang}"] = {"text": text, "kb": kb.model_dump_json(exclude_none=True) if kb else None}
+            job_id = await conn.fetchval(
+                "INSERT INTO broadcast_jobs (label, variants, parse_mode) VALUES ($1, $2, $3) RETURNING job_id",
+                label, json.dumps(variants), getattr(parse_mode, "value", parse_mode)
+            )
+            # قائمة المستلمين تُحفظ كاملة مع المهمة حتى يمكن الاستئناف بعد إعادة التشغيل
+            await conn.execute(f"""
+                INSERT INTO broadcast_deliveries (job_id, user_id, is_paid, lang)
+                SELECT $1, a.user_id, a.is_paid, a.lang FROM ({BROADCAST_AUDIENCE_SQL}) a
+            """, job_id)
+    print(f"📝 {label}: broadcast job #{job_id} queued")
+    return job_id
+
+BROADCAST_CLAIM_SQL = """
+    UPDATE broadcast_deliveries d
+    SET status = 'claimed', claimed_at = now(), attempts = d.attempts + 1
+    FROM (
+        SELECT job_id, user_id FROM broadcast_deliveries
+        WHERE job_id = $1
+          AND (status = 'pending' OR (status = 'claimed' AND claimed_at < now() - make_interval(secs => $3)))
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    ) c
+    WHERE d.job_id = c.job_id AND d.user_id = c.user_id
+    RETURNING d.user_id, d.is_paid, d.lang
+"""
+
+async def run_broadcast_job(pool, job):
+    job_id, label = job['job_id'], job['label']
+    variants = {}
+    for key, v in json.loads(job['variants']).items():
+        kb = InlineKeyboardMarkup.model_validate_json(v["kb"]) if v["kb"] else None
+        variants[key] = (v["text"], kb)
+
+    stats = {"label": label, "job_id": job_id, "sent": 0, "blocked": 0, "failed": 0}
+    broadcast_stats.update(stats)
+    started = time.monotonic()
+
+    async def deliver(row):
+        text, kb = variants[f"{int(row['is_paid'])}:{row['lang']}"]
+        result = await send_with_retry(row['user_id'], text, broadcast_bucket, reply_markup=kb, parse_mode=job['parse_mode'])
+        stats[result] += 1
+        # الحالة تُسجل فور الإرسال، فإعادة التشغيل لا تعيد إرسال رسالة وصلت
+        await pool.execute(
+            "UPDATE broadcast_deliveries SET status = $3, sent_at = now() WHERE job_id = $1 AND user_id = $2",
+            job_id, row['user_id'], result
+        )
+        if result == "blocked":
+            await pool.execute("UPDATE users_info SET blocked = TRUE WHERE user_id = $1", row['user_id'])
+
+    while True:
+        batch = await pool.fetch(BROADCAST_CLAIM_SQL, job_id, BROADCAST_BATCH_SIZE, BROADCAST_CLAIM_TIMEOUT)
+        if not batch:
+            break
+        queue = asyncio.Queue()
+        for row in batch:
+            queue.put_nowait(row)
+
+        async def worker():
+            while not queue.empty():
+                await deliver(queue.get_nowait())
+
+        await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(batch)))))
+        done = stats["sent"] + stats["blocked"] + stats["failed"]
+        print(f"📤 {label}: {done} delivered by this worker ({done / max(time.monotonic() - started, 1e-6):.1f} msg/s)")
+        broadcast_stats.update(stats)
+
+    # تُغلق المهمة فقط عندما لا يبقى أي مستلم معلق أو محجوز لدى نسخة أخرى
+    await pool.execute("""
+        UPDATE broadcast_jobs SET status = 'done', finished_at = now()
+        WHERE job_id = $1 AND status <> 'done' AND NOT EXISTS (
+            SELECT 1 FROM broadcast_deliveries WHERE job_id = $1 AND status IN ('pending', 'claimed')
+        )
+    """, job_id)
+    elapsed = time.monotonic() - started
+    stats["elapsed"] = round(elapsed, 1)
+    broadcast_stats.update(stats)
+    if stats["sent"] + stats["blocked"] + stats["failed"]:
+        print(f"✅ {label}: sent {stats['sent']}, blocked {stats['blocked']}, failed {stats['failed']} in {stats['elapsed']}s")
+
+async def process_broadcast_jobs(pool):
+    # تعمل على كل نسخة من البوت؛ SKIP LOCKED يوزع الدفعات بين النسخ بدون تكرار
+    while True:
+        try:
+            jobs = await pool.fetch(
+                "SELECT job_id, label, variants, parse_mode FROM broadcast_jobs WHERE status = 'pending' ORDER BY job_id"
+            )
+            for job in jobs:
+                await run_broadcast_job(pool, job)
+        except Exception as e:
+            print(f"Broadcast worker error: {e}")
+        await asyncio.sleep(BROADCAST_POLL_INTERVAL)
+
+# --- جدولة دائمة للحلقات الخلفية (لا تبدأ من الصفر بعد إعادة النشر) ---
+async def wait_for_schedule(pool, name):
+    next_run = await pool.fetchval("SELECT next_run_at FROM scheduler_state WHERE name = $1", name)
+    if next_run is not None:
+        delay = next_run.timestamp() - time.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+async def mark_scheduled(pool, name, interval):
+    await pool.execute("""
+        INSERT INTO scheduler_state (name, next_run_at) VALUES ($1, now() + make_interval(secs => $2))
+        ON CONFLICT (name) DO UPDATE SET next_run_at = EXCLUDED.next_run_at
+    """, name, float(interval))
+
+# --- ماسح الإشارات (ترتيب كل العملات حسب الاختراق/قفزة الحجم/الزخم) ---
+def _robust_z(x):
+    med = np.median(x)
+    mad = np.median(np.abs(x - med)) * 1.4826
+    return np.clip((x - med) / (mad + 1e-9), -5, 5)
+
+class SignalScanner:
+    """
+    تاريخ الأسعار والأحجام لكل رمز محفوظ في مصفوفتين float32 بحجم (عدد الرموز، SCAN_HISTORY)،
+    كل عمود عينة من دورة مسح، والعمود الأخير هو الأحدث.
+    """
+
+    def __init__(self, history=SCAN_HISTORY):
+        self.history = history
+        self.index = {}
+        self.prices = np.zeros((0, history), dtype=np.float32)
+        self.volumes = np.zeros((0, history), dtype=np.float32)
+        self.filled = np.zeros(0, dtype=np.int32)
+        self.ranking = []   # [(coin, metrics)] مرتبة من الأقوى
+        self.recent = []    # آخر الرموز المنشورة لتجنب التكرار
+        self.stats = {"scans": 0, "universe": 0, "last_ms": 0.0}
+
+    def update(self, coins):
+        started = time.perf_counter()
+        # قد يتكرر الرمز في قائمة CMC؛ نحتفظ بأول عملة (الأعلى قيمة سوقية) كما في MarketDataService
+        unique = {}
+        for c in coins:
+            if "stablecoin" not in (c.get("tags") or []) and c["quote"]["USD"]["price"]:
+                unique.setdefault(c["symbol"], c)
+        coins = list(unique.values())
+        if not coins:
+            return
+
+        new = [c["symbol"] for c in coins if c["symbol"] not in self.index]
+        for sym in new:
+            self.index[sym] = len(self.index)
+        if new:
+            pad = np.zeros((len(new), self.history), dtype=np.float32)
+            self.prices = np.vstack([self.prices, pad])
+            self.volumes = np.vstack([self.volumes, pad])
+            self.filled = np.concatenate([self.filled, np.zeros(len(new), dtype=np.int32)])
+
+        # إزاحة كل السلاسل عموداً واحداً؛ الرموز الغائبة عن هذه الدورة تحتفظ بآخر قيمة لها
+        self.prices[:, :-1] = self.prices[:, 1:]
+        self.volumes[:, :-1] = self.volumes[:, 1:]
+
+        rows = np.fromiter((self.index[c["symbol"]] for c in coins), dtype=np.int64, count=len(coins))
+        usd = [c["quote"]["USD"] for c in coins]
+        self.prices[rows, -1] = [q["price"] for q in usd]
+        self.volumes[rows, -1] = [q.get("volume_24h") or 0 for q in usd]
+        self.filled[rows] = np.minimum(self.filled[rows] + 1, self.history)
+
+        P, V, f = self.prices[rows].astype(np.float64), self.volumes[rows].astype(np.float64), self.filled[rows]
+        last, h = P[:, -1], self.history
+        pct_24h = np.array([q.get("percent_change_24h") or 0 for q in usd]) / 100
+        vol_change = np.array([q.get("volume_change_24h") or 0 for q in usd]) / 100
+
+        cols = np.arange(h)
+        prior = (cols[None, :] >= (h - f)[:, None]) & (cols[None, :] < h - 1)
+        n_prior = prior.sum(axis=1)
+
+        # الزخم: العائد مقابل SCAN_MOMENTUM_LOOKBACK دورة سابقة، أو تغير 24 ساعة إن لم يتوفر تاريخ كافٍ
+        k = np.minimum(f - 1, SCAN_MOMENTUM_LOOKBACK)
+        past = P[np.arange(len(rows)), h - 1 - k]
+        momentum = np.where((k > 0) & (past > 0), last / np.where(past > 0, past, 1) - 1, pct_24h)
+
+        # الاختراق: موقع السعر الحالي فوق أعلى قمة سابقة نسبةً لعرض القناة
+        prior_max = np.where(prior, P, -np.inf).max(axis=1)
+        prior_min = np.where(prior, P, np.inf).min(axis=1)
+        width = prior_max - prior_min
+        breakout = np.where((n_prior > 1) & (width > 0), (last - prior_max) / np.where(width > 0, width, 1), pct_24h)
+
+        # قفزة الحجم: volume_24h تراكمي متحرك فلا يتغير كثيراً بين عينة وأخرى؛ نستخدم حجم اليوم مقابل أمس من CMC،
+        # وتسارع الحجم المتحرك خلال نافذة الزخم كإشارة قصيرة المدى
+        surge = np.maximum(1 + vol_change, 1e-6)
+        past_vol = V[np.arange(len(rows)), h - 1 - k]
+        vol_accel = np.where((k > 0) & (past_vol > 0), V[:, -1] / np.where(past_vol > 0, past_vol, 1) - 1, 0.0)
+        volume_score = 0.6 * _robust_z(np.log(surge)) + 0.4 * _robust_z(vol_accel)
+
+        score = 0.4 * _robust_z(breakout) + 0.3 * volume_score + 0.3 * _robust_z(momentum)
+        score = np.where(V[:, -1] >= SCAN_MIN_VOLUME, score, -np.inf)
+        rank_scale = 100 / max(len(rows) - 1, 1)
+        trend_pct = momentum.argsort().argsort() * rank_scale
+        volume_pct = volume_score.argsort().argsort() * rank_scale
+
+        order = np.argsort(-score)
+        self.ranking = [
+            (coins[i], {"score": float(score[i]), "breakout": float(breakout[i]), "surge": float(surge[i]),
+                        "momentum": float(momentum[i]), "trend_pct": float(trend_pct[i]),
+                        "volume_pct": float(volume_pct[i])})
+            for i in order[:200] if np.isfinite(score[i])
+        ]
+        self.stats["scans"] += 1
+        self.stats["universe"] = len(rows)
+        self.stats["last_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+    def pick(self):
+        for coin, metrics in self.ranking:
+            if coin["symbol"] not in self.recent:
+                self.recent = (self.recent + [coin["symbol"]])[-10:]
+                return coin, metrics
+        return None
+
+signal_scanner = SignalScanner() if np is not None else None
+
+if signal_scanner is not None:
+    # الماسح يعمل مع كل تحديث للقطة السوق المشتركة
+    market_data.subscribe(lambda snap: signal_scanner.update(snap.coins))
+
+async def pick_signal_coin(limit):
+    """يعيد (coin, metrics) من الماسح، أو اختياراً عشوائياً من أفضل `limit` عملة في اللقطة إذا لم يجهز الماسح."""
+    try:
+        await asyncio.wait_for(market_data.ready.wait(), timeout=120)
+    except asyncio.TimeoutError:
+        return None, None
+    picked = signal_scanner.pick() if signal_scanner is not None else None
+    if picked is not None:
+        return picked
+    coins = market_data.snapshot.coins[:limit]
+    return (random.choice(coins), None) if coins else (None, None)
 
 # --- رادار الفرص الذكي ---
 async def ai_opportunity_radar(pool):
     while True:
         try:
-            headers = {"X-CMC_PRO_API_KEY": CMC_KEY}
-            async with httpx.AsyncClient() as client:
-                res = await client.get("https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest", 
-                                     headers=headers, params={"limit": "50"})
-                
-                if res.status_code == 200:
-                    selected_coin = random.choice(res.json()["data"])
-                    symbol = selected_coin["symbol"]
-                    price = selected_coin["quote"]["USD"]["price"]
-                    price_display = f"{price:.8f}" if price < 1 else f"{price:,.2f}"
-
-                    # --- توليد التحليل مرة واحدة فقط لكل لغة لتوفير الـ API والوقت ---
-                    # تحليل للـ VIP (عربي وانجليزي)
-                    insight_vip_ar = await ask_groq(f"Give a very short 2-line technical breakout insight for #{symbol} at ${price_display}. Answer strictly in Arabic.", lang="ar")
-                    insight_vip_en = await ask_groq(f"Give a very short 2-line technical breakout insight for #{symbol} at ${price_display}. Answer strictly in English.", lang="en")
-                    
-                    # تلميح للمجاني (عربي وانجليزي)
-                    hint_free_ar = await ask_groq(f"Write a 1-line technical breakout hint for a coin at ${price_display}. DO NOT mention the coin name. Answer strictly in Arabic.", lang="ar")
-                    hint_free_en = await ask_groq(f"Write a 1-line technical breakout hint for a coin at ${price_display}. DO NOT mention the coin name. Answer strictly in English.", lang="en")
-
-                    users = await pool.fetch("SELECT user_id, lang FROM users_info")
-                    
-                    for row in users:
-                        uid, lang = row['user_id'], row['lang'] or "ar"
-                        is_paid = await is_user_paid(pool, uid)
-                        
-                        if is_paid:
-                            insight = insight_vip_ar if lang == "ar" else insight_vip_en
-                            text = (f"🚨 **VIP BREAKOUT ALERT**\n\n"
-                                    f"💎 **العملة:** #{symbol.upper()}\n"
-                                    f"💵 **السعر:** `${price_display}`\n"
-                                    f"📈 **الرؤية:**\n{insight}")
-                        else:
-                            insight = hint_free_ar if lang == "ar" else hint_free_en
-                            if lang == "ar":
-                                text = (f"📡 **رادار الفرص الذكي**\n"
-                                        f"───────────────────\n"
-                                        f"🔥 **تم رصد انفجار سعري محتمل الآن!**\n\n"
-                                        f"📊 **العملة:** `•••••` 🔒\n"
-                                        f"💰 **السعر الحالي:** `${price_display}`\n"
-                                        f"📈 **تلميح تقني:**\n_{insight}_\n\n"
-                                        f"📢 **اشترك الآن لكشف اسم العملة والأهداف!**")
-                            else:
-                                text = (f"📡 **SMART RADAR ALERT**\n"
-                                        f"───────────────────\n"
-                                        f"🔥 **Potential Breakout Detected!**\n\n"
-                                        f"📊 **Symbol:** `•••••` 🔒\n"
-                                        f"💰 **Price:** `${price_display}`\n"
-                                        f"📈 **Technical Hint:**\n_{insight}_\n\n"
-                                        f"📢 **Subscribe VIP to unlock the symbol!**")
-                        
-                        try:
-                            await bot.send_message(uid, text, reply_markup=None if is_paid else get_payment_kb(lang), parse_mode=ParseMode.MARKDOWN)
-                            await asyncio.sleep(0.05) # تأخير بسيط لتجنب حظر التليجرام (Flood limit)
-                        except Exception:
-                            continue
+            await wait_for_schedule(pool, "radar")
+            await mark_scheduled(pool, "radar", RADAR_INTERVAL)
+        except Exception as e:
+            print(f"Radar schedule error: {e}")
+            await asyncio.sleep(60)
+            continue
+
+        try:
+            selected_coin, _ = await pick_signal_coin(limit=50)
+            if selected_coin is not None:
+                symbol = selected_coin["symbol"]
+                price = selected_coin["quote"]["USD"]["price"]
+                price_display = f"{price:.8f}" if price < 1 else f"{price:,.2f}"
+
+                # --- توليد التحليل مرة واحدة فقط لكل لغة لتوفير الـ API والوقت ---
+                # كل النسخ (VIP/مجاني × اللغات) في طلب JSON واحد، مع بديل متوازٍ لأي نسخة تفشل
+                radar_texts = await generate_radar_texts(symbol, price_display)
+
+                # كل نسخة من الرسالة تُبنى مرة واحدة فقط لكل (VIP/مجاني، لغة)
+                def render(is_paid, lang):
+                    variant = "vip" if is_paid else "free"
+                    insight = radar_texts.get((variant, lang)) or radar_texts[(variant, "en")]
+                    text = i18n.text(f"radar_{variant}", lang, symbol=symbol.upper(), price=price_display, insight=insight)
+                    return text, None if is_paid else i18n.kb("payment", lang)
+
+                await broadcast(pool, render, label=f"Radar #{symbol}", parse_mode=ParseMode.MARKDOWN)
         except Exception as e:
             print(f"Radar Error: {e}")
-            
-        await asyncio.sleep(84000) # انتطار الدورة القادمة
-async def daily_channel_post():
+
+async def daily_channel_post(pool):
     # معرف القناة (تأكد من كتابة يوزر قناتك هنا)
     CHANNEL_ID = "@AiCryptoGPT" 
     
     while True:
         try:
-            headers = {"X-CMC_PRO_API_KEY": CMC_KEY}
-            async with httpx.AsyncClient() as client:
-                # نجلب أفضل 100 عملة لنختار منها
-                res = await client.get("https://pro-api.coinmarketcap.com/v1/cryptocurrency/listings/latest", 
-                                     headers=headers, params={"limit": "100"})
+            await wait_for_schedule(pool, "channel_post")
+            await mark_scheduled(pool, "channel_post", CHANNEL_POST_INTERVAL)
+        except Exception as e:
+            print(f"Channel post schedule error: {e}")
+            await asyncio.sleep(60)
+            continue
+
+        try:
+            # العملة الأقوى حسب الماسح (أو اختيار من أفضل 100 إذا لم يجهز بعد)
+            selected_coin, metrics = await pick_signal_coin(limit=100)
+            if selected_coin is not None and not metrics:
+                # بدون ترتيب حقيقي من الماسح (NumPy غير متوفر أو لم يجهز بعد) لا ننشر أرقاماً مختلقة
+                print("Channel post skipped: no scanner metrics yet")
+            elif selected_coin is not None:
+                symbol = selected_coin["symbol"]
+                price = selected_coin["quote"]["USD"]["price"]
+                price_display = f"{price:.4f}" if price > 1 else f"{price:.8f}"
                 
-                if res.status_code == 200:
-                    selected_coin = random.choice(res.json()["data"])
-                    symbol = selected_coin["symbol"]
-                    price = selected_coin["quote"]["USD"]["price"]
-                    price_display = f"{price:.4f}" if price > 1 else f"{price:.8f}"
-                    
-                    # توليد أرقام عشوائية للمؤشرات
-                    vol_val = round(random.uniform(40, 150), 1)
-                    trend_val = random.randint(40, 98)
-
-                    # دالة لتحديد وصف القوة بناءً على الرقم
-                    def get_power_desc(val):
-                        if val < 50: return "ضعيف ⚠️"
-                        elif 50 <= val < 60: return "متوسط ⚖️"
-                        elif 60 <= val < 80: return "قوي 💪"
-                        else: return "قوي جداً 🔥"
-
-                    vol_desc = get_power_desc(vol_val)
-                    trend_desc = get_power_desc(trend_val)
-
-                    # صياغة المنشور بالتنسيق المطلوب بالضبط
-                    post_text = (
-                        f"━━━━━━━━━━━━\n"
-                        f"🚨 **SMART MONEY ALERT**\n"
-                        f"━━━━━━━━━━━━\n"
-                        f"⏱️ الفريم: 15m\n"
-                        f"💰 العملة: `{symbol}USDT`\n"
-                        f"💵 السعر: `{price_display}`\n"
-                        f"━━━━━━━━━━━━\n"
-                        f"▪️ الحالة: ✅ إغلاق شمعة\n"
-                        f"▪️ قوة الحجم: {vol_val}% ({vol_desc})\n"
-                        f"▪️ قوة الاتجاه: {trend_val}% ({trend_desc})\n"
-                        f"━━━━━━━━━━━━\n"
-                        f"🔒 الاتجاه والأهداف مخفية\n"
-                        f"━━━━━━━━━━━━\n"
-                        f"👁️‍🗨️ لمعرفة الاتجاه + TP/SL\n"
-                        f"اضغط هنا 👇"
-                    )
-
-                    # إعداد الزر لفتح البوت
-                    bot_info = await bot.get_me()
-                    kb = InlineKeyboardMarkup(inline_keyboard=[[
-                        InlineKeyboardButton(text="🖥 تحليل الاتجاه الآن", url=f"https://t.me/{bot_info.username}?start=analyze_{symbol}")
-                    ]])
-
-                    # إرسال المنشور للقناة
-                    await bot.send_message(CHANNEL_ID, post_text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
-                    print(f"✅ تم نشر توصية القناة لعملة {symbol}")
+                # قوة الحجم وقوة الاتجاه = ترتيب العملة بين كل العملات (0-100) حسب إشارة الحجم والزخم
+                vol_val = round(metrics["volume_pct"], 1)
+                trend_val = round(metrics["trend_pct"])
+
+                # دالة لتحديد وصف القوة بناءً على الرقم
+                def get_power_desc(val):
+                    if val < 50: return "ضعيف ⚠️"
+                    elif 50 <= val < 60: return "متوسط ⚖️"
+                    elif 60 <= val < 80: return "قوي 💪"
+                    else: return "قوي جداً 🔥"
+
+                vol_desc = get_power_desc(vol_val)
+                trend_desc = get_power_desc(trend_val)
+
+                # صياغة المنشور بالتنسيق المطلوب بالضبط
+                post_text = (
+                    f"━━━━━━━━━━━━\n"
+                    f"🚨 **SMART MONEY ALERT**\n"
+                    f"━━━━━━━━━━━━\n"
+                    f"⏱️ الفريم: 15m\n"
+                    f"💰 العملة: `{symbol}USDT`\n"
+                    f"💵 السعر: `{price_display}`\n"
+                    f"━━━━━━━━━━━━\n"
+                    f"▪️ الحالة: ✅ إغلاق شمعة\n"
+                    f"▪️ قوة الحجم: {vol_val}% ({vol_desc})\n"
+                    f"▪️ قوة الاتجاه: {trend_val}% ({trend_desc})\n"
+                    f"━━━━━━━━━━━━\n"
+                    f"🔒 الاتجاه والأهداف مخفية\n"
+                    f"━━━━━━━━━━━━\n"
+                    f"👁️‍🗨️ لمعرفة الاتجاه + TP/SL\n"
+                    f"اضغط هنا 👇"
+                )
+
+                # إعداد الزر لفتح البوت
+                bot_info = await bot.get_me()
+                kb = InlineKeyboardMarkup(inline_keyboard=[[
+                    InlineKeyboardButton(text="🖥 تحليل الاتجاه الآن", url=f"https://t.me/{bot_info.username}?start=analyze_{symbol}")
+                ]])
+
+                # إرسال المنشور للقناة
+                await bot.send_message(CHANNEL_ID, post_text, reply_markup=kb, parse_mode=ParseMode.MARKDOWN)
+                print(f"✅ تم نشر توصية القناة لعملة {symbol}")
 
         except Exception as e:
             print(f"Error in channel post: {e}")
-            
-        # الانتظار 24 ساعة (86400 ثانية)
-        await asyncio.sleep(21600) 
 
 
 # --- نظام الـ AI ---
-async def ask_groq(prompt, lang="ar"):
-    headers = {"Authorization": f"Bearer {GROQ_API_KEY}", "Content-Type": "application/json"}
-    data = {"model": GROQ_MODEL, "messages": [{"role": "user", "content": prompt}]}
+GROQ_ERROR_TEXT = "⚠️ Error generating analysis"
+
+class GroqUnavailable(Exception):
+    pass
+
+class GroqRetryable(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class AdaptiveLimiter:
+    """حد تزامن يتقلص عند 429 أو عند اقتراب رصيد Groq من النفاد، ويتوسع تدريجياً مع النجاح."""
+
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = max_limit
+        self.active = 0
+        self.paused_until = 0.0
+        self._cond = asyncio.Condition()
+
+    async def __aenter__(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        async with self._cond:
+            await self._cond.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+
+    async def __aexit__(self, *exc):
+        async with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+    def on_throttle(self):
+        self.limit = max(self.min_limit, self.limit // 2)
+
+    def on_success(self):
+        if self.limit < self.max_limit:
+            self.limit += 1
+
+    def update_from_headers(self, headers):
+        # remaining-requests عداد يومي لا يعكس الضغط الحالي؛ رصيد التوكنات يتجدد كل دقيقة وهو ما ينفد أولاً
+        remaining = headers.get("x-ratelimit-remaining-tokens")
+        if remaining is None or not remaining.isdigit():
+            return
+        calls_left = int(remaining) // GROQ_TOKENS_PER_CALL
+        if calls_left < self.limit:
+            self.limit = max(self.min_limit, calls_left)
+        reset = _parse_groq_duration(headers.get("x-ratelimit-reset-tokens"))
+        if calls_left == 0 and reset:
+            self.paused_until = time.monotonic() + min(reset, GROQ_BACKOFF_MAX)
+
+GROQ_DURATION_RE = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+GROQ_DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+def _parse_groq_duration(value):
+    # Groq يرسل مدة إعادة التعبئة بصيغة مثل "7.66s" أو "1m2.5s" أو "120ms"
+    if not value:
+        return None
+    parts = GROQ_DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * GROQ_DURATION_UNITS[unit] for n, unit in parts)
+
+class CircuitBreaker:
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    def allow(self):
+        return time.monotonic() >= self.open_until
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.open_until = time.monotonic() + self.cooldown
+            # بعد انتهاء مهلة الإغلاق يكفي فشل واحد لإعادة فتح القاطع (half-open)
+            self.failures = self.threshold - 1
+
+def _retry_after(headers):
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+GROQ_RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+class GroqGateway:
+    def __init__(self, primary, fallback=None):
+        self.models = [primary] + ([fallback] if fallback and fallback != primary else [])
+        self.limiter = AdaptiveLimiter(HTTP_MAX_CONCURRENCY_GROQ)
+        self.breakers = {m: CircuitBreaker(GROQ_BREAKER_THRESHOLD, GROQ_BREAKER_COOLDOWN) for m in self.models}
+        self.stats = {m: {"calls": 0, "errors": 0, "retries": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                          "latency_total": 0.0, "latency_ewma": 0.0} for m in self.models}
+
+    def _models_in_order(self):
+        order = list(self.models)
+        # إذا تجاوز زمن الاستجابة الـ SLO نحول أغلب الطلبات للنموذج الأسرع ونترك 10% لقياس تعافي الأساسي
+        if len(order) > 1 and self.stats[order[0]]["latency_ewma"] > GROQ_LATENCY_SLO and random.random() > 0.1:
+            order.reverse()
+        return [m for m in order if self.breakers[m].allow()]
+
+    async def complete(self, data, on_delta=None):
+        models = self._models_in_order()
+        if not models:
+            raise GroqUnavailable("all Groq circuits are open")
+        last_error = None
+        for model in models:
+            try:
+                return await self._call(model, {**data, "model": model}, on_delta)
+            except GroqUnavailable as e:
+                last_error = e
+        raise last_error
+
+    async def _call(self, model, data, on_delta):
+        stats, breaker = self.stats[model], self.breakers[model]
+        for attempt in range(GROQ_MAX_RETRIES + 1):
+            started = time.monotonic()
+            stats["calls"] += 1
+            try:
+                async with self.limiter:
+                    if on_delta is None:
+                        text, usage = await self._request(data)
+                    else:
+                        text, usage = await self._stream(data, on_delta)
+            except GroqRetryable as e:
+                stats["errors"] += 1
+                breaker.failure()
+                if e.status == 429:
+                    self.limiter.on_throttle()
+                if attempt == GROQ_MAX_RETRIES or not breaker.allow():
+                    raise GroqUnavailable(f"{model}: {e}")
+                if e.retry_after is not None and e.retry_after > GROQ_BACKOFF_MAX:
+                    # انتظار أطول من السقف يعني أن رصيد هذا النموذج نفد؛ ننتقل للنموذج الاحتياطي بدل حجز الطلب
+                    raise GroqUnavailable(f"{model}: {e} (retry after {e.retry_after:.0f}s)")
+                stats["retries"] += 1
+                delay = e.retry_after if e.retry_after is not None else random.uniform(0, min(GROQ_BACKOFF_MAX, GROQ_BACKOFF_BASE * 2 ** attempt))
+                await asyncio.sleep(delay)
+                continue
+            except GroqUnavailable:
+                stats["errors"] += 1
+                raise
+
+            latency = time.monotonic() - started
+            breaker.success()
+            self.limiter.on_success()
+            stats["latency_total"] += latency
+            stats["latency_ewma"] = latency if not stats["latency_ewma"] else 0.8 * stats["latency_ewma"] + 0.2 * latency
+            stats["prompt_tokens"] += usage.get("prompt_tokens", 0)
+            stats["completion_tokens"] += usage.get("completion_tokens", 0)
+            return text
+
+    async def _request(self, data):
+        if "groq" not in http_clients:
+            await open_http_clients()
+        try:
+            res = await http_clients["groq"].post("/openai/v1/chat/completions", json=data)
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            count_transport_error("groq", e)
+            raise GroqRetryable(repr(e))
+        self.limiter.update_from_headers(res.headers)
+        if res.status_code in GROQ_RETRYABLE_STATUS:
+            raise GroqRetryable(f"HTTP {res.status_code}", res.status_code, _retry_after(res.headers))
+        if res.status_code != 200:
+            raise GroqUnavailable(f"HTTP {res.status_code}: {res.text[:200]}")
+        try:
+            body = res.json()
+            return body["choices"][0]["message"]["content"], body.get("usage") or {}
+        except (ValueError, KeyError, IndexError) as e:
+            raise GroqUnavailable(f"bad response: {e}")
+
+    async def _stream(self, data, on_delta):
+        if "groq" not in http_clients:
+            await open_http_clients()
+        parts, usage = [], {}
+        try:
+            async with http_clients["groq"].stream("POST", "/openai/v1/chat/completions", json={**data, "stream": True}) as res:
+                self.limiter.update_from_headers(res.headers)
+                if res.status_code in GROQ_RETRYABLE_STATUS:
+                    raise GroqRetryable(f"HTTP {res.status_code}", res.status_code, _retry_after(res.headers))
+                if res.status_code != 200:
+                    raise GroqUnavailable(f"HTTP {res.status_code}")
+                async for line in res.aiter_lines():
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    chunk = json.loads(payload)
+                    usage = chunk.get("usage") or chunk.get("x_groq", {}).get("usage") or usage
+                    if not chunk.get("choices"):
+                        continue
+                    delta = chunk["choices"][0]["delta"].get("content")
+                    if delta:
+                        parts.append(delta)
+                        await on_delta("".join(parts))
+        except (httpx.TimeoutException, httpx.TransportError) as e:
+            count_transport_error("groq", e)
+            raise GroqRetryable(repr(e))
+        except (ValueError, KeyError, IndexError) as e:
+            raise GroqUnavailable(f"bad stream chunk: {e}")
+        if not parts:
+            raise GroqUnavailable("empty stream")
+        return "".join(parts), usage
+
+groq_gateway = GroqGateway(GROQ_MODEL, GROQ_FALLBACK_MODEL)
+
+async def ask_groq(prompt, lang="ar", on_delta=None, json_mode=False):
+    """
+    إذا مُررت on_delta يُطلب الرد بنمط البث (SSE) وتُستدعى on_delta(النص حتى الآن) مع كل جزء يصل.
+    في الحالتين تعيد النص الكامل، أو GROQ_ERROR_TEXT بعد استنفاد إعادة المحاولة والنموذج البديل.
+    """
+    data = {"messages": [{"role": "user", "content": prompt}]}
+    if json_mode:
+        data["response_format"] = {"type": "json_object"}
 
     try:
-        async with httpx.AsyncClient(timeout=45) as client:
-            res = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers=headers,
-                json=data
-            )
-            ans = res.json()["choices"][0]["message"]["content"]
-            return ans
-    except:
-        return "⚠️ Error generating analysis"
+        return await groq_gateway.complete(data, on_delta=on_delta)
+    except GroqUnavailable as e:
+        print(f"Groq unavailable: {e}")
+        return GROQ_ERROR_TEXT
+
+RADAR_LANGS = i18n.langs
+LANG_NAMES = {l: i18n.text("lang_name", l) for l in i18n.langs}
+
+def radar_prompts(symbol, price_display, langs=RADAR_LANGS):
+    prompts = {}
+    for l in langs:
+        prompts[("vip", l)] = f"Give a very short 2-line technical breakout insight for #{symbol} at ${price_display}. Answer strictly in {LANG_NAMES[l]}."
+        prompts[("free", l)] = f"Write a 1-line technical breakout hint for a coin at ${price_display}. DO NOT mention the coin name. Answer strictly in {LANG_NAMES[l]}."
+    return prompts
+
+async def generate_radar_texts(symbol, price_display, langs=RADAR_LANGS):
+    """يعيد dict: (vip|free, lang) -> نص."""
+    prompts = radar_prompts(symbol, price_display, langs)
+    results = {}
+
+    # طلب واحد بنمط JSON يولد كل النسخ دفعة واحدة
+    spec = "\n".join(f'- "{kind}_{l}": {p}' for (kind, l), p in prompts.items())
+    combined = (f"Return a JSON object with exactly these keys. Each value is a plain string answering its instruction:\n{spec}")
+    try:
+        obj = json.loads(await ask_groq(combined, json_mode=True))
+        for kind, l in prompts:
+            value = obj.get(f"{kind}_{l}")
+            if isinstance(value, str) and value.strip():
+                results[(kind, l)] = value.strip()
+    except Exception as e:
+        print(f"Radar JSON generation failed, falling back per variant: {e}")
+
+    # أي نسخة ناقصة تُولد منفردة وبالتوازي (التزامن محدود بسيمافور Groq المشترك)
+    missing = [k for k in prompts if k not in results]
+    if missing:
+        texts = await asyncio.gather(*(ask_groq(prompts[k], lang=k[1]) for k in missing))
+        results.update(zip(missing, texts))
+    return results
+
+def html_safe_prefix(text):
+    # نعرض فقط حتى آخر سطر مكتمل تكون فيه وسوم HTML مغلقة، حتى لا يرفض تيليجرام التعديل
+    cut = text.rfind("\n")
+    while cut > 0:
+        prefix = text[:cut]
+        if prefix.count("<") == prefix.count(">") and all(
+            prefix.count(f"<{t}>") == prefix.count(f"</{t}>") for t in ("b", "i", "u", "code")
+        ):
+            return prefix
+        cut = text.rfind("\n", 0, cut)
+    return ""
+
+class StreamingEditor:
+    """يعدّل رسالة واحدة تدريجياً أثناء وصول الرد، مع احترام حدود تيليجرام لتعديل الرسائل."""
+
+    def __init__(self, message, interval=None):
+        self.message = message
+        self.interval = interval or STREAM_EDIT_INTERVAL
+        self._next_edit = 0.0
+        self._shown = ""
+
+    async def update(self, text):
+        now = time.monotonic()
+        if now < self._next_edit:
+            return
+        safe = html_safe_prefix(text)
+        if not safe or safe == self._shown:
+            return
+        self._next_edit = now + self.interval
+        try:
+            await self.message.edit_text(safe + "\n▌", parse_mode=ParseMode.HTML)
+            self._shown = safe
+        except TelegramRetryAfter as e:
+            self._next_edit = time.monotonic() + e.retry_after
+        except Exception as e:
+            # التعديل المرحلي شكلي فقط؛ أي فشل فيه يجب ألا يوقف توليد التحليل نفسه
+            print(f"Stream edit skipped: {e}")
 
 # --- الأوامر ---
 @dp.message(Command("status"))
 async def status_cmd(m: types.Message):
     pool = dp['db_pool']
     
-    # 1. إجمالي المستخدمين
-    total = await pool.fetchval("SELECT count(*) FROM users_info")
-    # 2. إجمالي المشتركين VIP
-    vips = await pool.fetchval("SELECT count(*) FROM paid_users")
-    # 3. إجمالي الذين استخدموا التجربة المجانية (الموجودين في جدول trial_users)
-    total_trials = await pool.fetchval("SELECT count(*) FROM trial_users")
-    # 4. النشطين اليوم (الذين أرسلوا رسائل اليوم)
-    active_today = await pool.fetchval("SELECT count(*) FROM users_info WHERE last_active = CURRENT_DATE")
+    # العدادات تُحدَّث تلقائياً عبر التريغر على users_info، فالقراءة هنا ثابتة التكلفة
+    counters = {r['name']: r['value'] for r in await pool.fetch(
+        "SELECT name, sum(value)::bigint AS value FROM stats_counters GROUP BY name"
+    )}
+    rows = await pool.fetch("""
+        SELECT day, metric, sum(value)::bigint AS value, CURRENT_DATE AS today FROM stats_daily
+        WHERE day > CURRENT_DATE - 7 GROUP BY day, metric ORDER BY day DESC
+    """)
+    daily = {}
+    for r in rows:
+        daily.setdefault(r['day'], {})[r['metric']] = r['value']
+
+    total, vips, total_trials = counters.get('total', 0), counters.get('vips', 0), counters.get('trials', 0)
+    today = daily.get(rows[0]['today'], {}) if rows else {}
+    active_today = today.get('active', 0)
+
+    # اتجاه آخر 7 أيام: تسجيلات جديدة / تحويلات VIP / نشطين
+    trend = "\n".join(
+        f"`{day:%m-%d}` ➕{d.get('signups', 0)} 💎{d.get('conversions', 0)} 🔥{d.get('active', 0)}"
+        for day, d in daily.items()
+    )
     
     msg = (f"📊 **إحصائيات البوت المتقدمة:**\n"
            f"───────────────────\n"
            f"👥 **إجمالي القاعدة:** `{total}` مستخدم\n"
            f"🔥 **النشاط اليومي:** `{active_today}` مستخدم نشط\n"
            f"🎁 **مستخدمي التجربة:** `{total_trials}` شخص\n"
-           f"💎 **المشتركين VIP:** `{vips}` مشترك")
+           f"💎 **المشتركين VIP:** `{vips}` مشترك\n"
+           f"🆕 **تسجيلات اليوم:** `{today.get('signups', 0)}` / **تحويلات اليوم:** `{today.get('conversions', 0)}`\n"
+           f"───────────────────\n"
+           f"📈 **آخر 7 أيام:**\n{trend}\n"
+           f"⚡ **كاش الأسعار:** hits `{quote_cache.stats['hits']}` / misses `{quote_cache.stats['misses']}` / stale `{quote_cache.stats['stale']}`\n"
+           f"🛰 **بيانات السوق:** v`{market_data.snapshot.version}` / snapshot hits `{market_data.stats['quote_hits']}` / CMC credits/h `{market_data.credits_last_hour()}`\n"
+           + "".join(
+               f"🤖 **{model}:** calls `{st['calls']}` / errors `{st['errors']}` / "
+               f"latency `{st['latency_ewma']:.1f}s` / tokens `{st['prompt_tokens'] + st['completion_tokens']}`\n"
+               for model, st in groq_gateway.stats.items()
+           ))
     
     await m.answer(msg, parse_mode=ParseMode.MARKDOWN)
 
@@ -274,11 +2186,14 @@ async def clean_db_cmd(m: types.Message):
     
     pool = dp['db_pool']
     async with pool.acquire() as conn:
-        # حذف المستخدمين الذين ليس لديهم تجربة ولم يشتركوا
+        # حذف المستخدمين الذين ليس لديهم تجربة ولم يشتركوا ولا ينتظرون رسالة في بث مفتوح
         deleted_count = await conn.execute("""
-            DELETE FROM users_info
-            WHERE user_id NOT IN (SELECT user_id FROM paid_users)
-            AND user_id NOT IN (SELECT user_id FROM trial_users)
+            DELETE FROM users_info u
+            WHERE NOT u.is_paid AND NOT u.trial_used
+            AND NOT EXISTS (
+                SELECT 1 FROM broadcast_deliveries d
+                WHERE d.user_id = u.user_id AND d.status IN ('pending', 'claimed')
+            )
         """)
     
     await m.answer(f"✅ تم تنظيف قاعدة البيانات. عدد المستخدمين المحذوفين: {deleted_count}")
@@ -286,13 +2201,14 @@ async def clean_db_cmd(m: types.Message):
 @dp.message(Command("start"))
 async def start_cmd(m: types.Message):
     async with dp['db_pool'].acquire() as conn:
-        await conn.execute("INSERT INTO users_info (user_id) VALUES ($1) ON CONFLICT DO NOTHING", m.from_user.id)
-    kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🇸🇦 العربية", callback_data="lang_ar"), InlineKeyboardButton(text="🇺🇸 English", callback_data="lang_en")]])
-    await m.answer("👋 أهلاً بك، يرجى اختيار لغتك:\nWelcome, please choose your language:", reply_markup=kb)
+        await conn.execute("INSERT INTO users_info (user_id) VALUES ($1) ON CONFLICT (user_id) DO UPDATE SET blocked = FALSE WHERE users_info.blocked", m.from_user.id)
+    await m.answer(i18n.choose_language, reply_markup=i18n.language_kb)
 
 @dp.callback_query(F.data.startswith("lang_"))
 async def set_lang(cb: types.CallbackQuery):
     lang = cb.data.split("_")[1]
+    if lang not in i18n.langs:
+        return await cb.answer()
 
     try:
         async with dp['db_pool'].acquire() as conn:
@@ -301,23 +2217,280 @@ async def set_lang(cb: types.CallbackQuery):
                 lang,
                 cb.from_user.id
             )
+            await notify_entitlement(conn, cb.from_user.id)
     except Exception as e:
         print(f"DB Error in set_lang: {e}")
         return await cb.answer("Server busy, try again...", show_alert=True)
+    invalidate_entitlement(cb.from_user.id)
     
-    is_paid = await is_user_paid(dp['db_pool'], cb.from_user.id)
-    has_tr = await has_trial(dp['db_pool'], cb.from_user.id)
+    ent = await get_entitlement(dp['db_pool'], cb.from_user.id)
+    is_paid, has_tr = ent.is_paid, ent.has_trial
 
     if is_paid:
-        msg = "✅ أهلاً بك مجدداً! اشتراكك مفعل.\nأرسل رمز العملة للتحليل." if lang == "ar" else "✅ Welcome back! Your subscription is active.\nSend a coin symbol to analyze."
+        msg = i18n.text("welcome_paid", lang)
     elif has_tr:
-        msg = "🎁 لديك تجربة مجانية واحدة! أرسل رمز العملة للتحليل." if lang == "ar" else "🎁 You have one free trial! Send a coin symbol for analysis."
+        msg = i18n.text("welcome_trial", lang)
     else:
-        msg = "⚠️ انتهت تجربتك المجانية. للوصول الكامل، يرجى الاشتراك مقابل 10 USDT أو 500 ⭐ لمرة واحدة." if lang == "ar" else "⚠️ Your free trial has ended. For full access, please subscribe for a one-time fee of 10 USDT or 500 ⭐."
+        msg = i18n.text("trial_ended", lang)
     
-    await cb.message.edit_text(msg, reply_markup=None if (is_paid or has_tr) else get_payment_kb(lang))
+    await cb.message.edit_text(msg, reply_markup=None if (is_paid or has_tr) else i18n.kb("payment", lang))
+
+# --- محرك المؤشرات الفنية (NumPy على شموع OHLCV حقيقية) ---
+class CandleStore:
+    """
+    يحتفظ بآخر CANDLE_WINDOW شمعة لكل (رمز، إطار) كمصفوفة (n, 6): open_time, open, high, low, close, volume.
+    التحديث تدريجي: نطلب فقط الشموع من آخر شمعة محفوظة ونستبدل الشمعة الأخيرة غير المغلقة.
+    """
+
+    def __init__(self, max_size=CANDLE_STORE_MAX):
+        self.max_size = max_size
+        self._series = OrderedDict()  # (sym, tf) -> (checked_at, ndarray)، الأقدم استخداماً أولاً
+        self._locks = {}              # (sym, tf) -> [Lock, عدد المنتظرين]
+
+    async def get(self, sym, tf):
+        key = (sym, tf)
+        entry = self._series.get(key)
+        if entry is not None and time.monotonic() - entry[0] < CANDLE_REFRESH[tf]:
+            self._series.move_to_end(key)
+            return entry[1]
+        slot = self._locks.get(key)
+        if slot is None:
+            slot = self._locks[key] = [asyncio.Lock(), 0]
+        slot[1] += 1
+        try:
+            async with slot[0]:
+                entry = self._series.get(key)
+                if entry is not None and time.monotonic() - entry[0] < CANDLE_REFRESH[tf]:
+                    self._series.move_to_end(key)
+                    return entry[1]
+                old = entry[1] if entry is not None else None
+                new = await self._load(sym, tf, since=int(old[-1, 0]) if old is not None and len(old) else None)
+                if new is None:
+                    series = old
+                elif old is None or not len(old):
+                    series = new
+                else:
+                    series = np.concatenate([old[old[:, 0] < new[0, 0]], new])[-CANDLE_WINDOW:]
+                self._series[key] = (time.monotonic(), series)
+                self._series.move_to_end(key)
+                while len(self._series) > self.max_size:
+                    self._series.popitem(last=False)
+                return series
+        finally:
+            # القفل لا يلزم إلا أثناء وجود من ينتظره
+            slot[1] -= 1
+            if not slot[1]:
+                self._locks.pop(key, None)
+
+    async def _load(self, sym, tf, since=None):
+        if OHLCV_FIXTURE_DIR:
+            path = os.path.join(OHLCV_FIXTURE_DIR, f"{sym}_{tf}.json")
+            if not os.path.exists(path):
+                return None
+            with open(path, encoding="utf-8") as f:
+                rows = json.load(f)
+        else:
+            params = {"symbol": f"{sym}USDT", "interval": CANDLE_INTERVALS[tf], "limit": CANDLE_WINDOW}
+            if since is not None:
+                params["startTime"] = since
+            res = await upstream_request("binance", "GET", "/api/v3/klines", params=params)
+            if res.status_code != 200:
+                return None
+            rows = res.json()
+        if not rows:
+            return None
+        return np.array([r[:6] for r in rows], dtype=np.float64)[-CANDLE_WINDOW:]
+
+candle_store = CandleStore()
+
+def _ema(x, span):
+    # EMA متجهة بالكامل (بدون حلقة) عبر الصيغة المغلقة؛ آمنة عددياً لطول CANDLE_WINDOW
+    alpha = 2 / (span + 1)
+    n = len(x)
+    decay = (1 - alpha) ** np.arange(n)
+    scaled = np.cumsum(np.concatenate([[x[0]], alpha * x[1:] / decay[1:]]))
+    return scaled * decay
+
+def compute_indicators(candles):
+    close, high, low, volume = candles[:, 4], candles[:, 2], candles[:, 3], candles[:, 5]
+    if len(close) < 35:
+        return None
+
+    # RSI(14) بتنعيم Wilder (EMA بـ alpha = 1/14 تعادل span = 27)
+    delta = np.diff(close)
+    avg_gain = _ema(np.clip(delta, 0, None), 27)[-1]
+    avg_loss = _ema(np.clip(-delta, 0, None), 27)[-1]
+    rsi = 100.0 if avg_loss == 0 else 100 - 100 / (1 + avg_gain / avg_loss)
+
+    macd_line = _ema(close, 12) - _ema(close, 26)
+    signal = _ema(macd_line, 9)
+
+    window = np.lib.stride_tricks.sliding_window_view(close, 20)
+    mid, std = window.mean(axis=1)[-1], window.std(axis=1)[-1]
+
+    return {
+        "rsi": float(rsi),
+        "macd": float(macd_line[-1]),
+        "macd_signal": float(signal[-1]),
+        "macd_hist": float(macd_line[-1] - signal[-1]),
+        "bb_lower": float(mid - 2 * std),
+        "bb_mid": float(mid),
+        "bb_upper": float(mid + 2 * std),
+        "volume_ratio": float(volume[-1] / volume[-21:-1].mean()) if volume[-21:-1].mean() else 0.0,
+        "low_20": float(low[-20:].min()),
+        "high_20": float(high[-20:].max()),
+    }
+
+async def get_indicators(sym, tf):
+    if np is None or tf not in CANDLE_INTERVALS:
+        return None
+    try:
+        candles = await candle_store.get(sym, tf)
+        return compute_indicators(candles) if candles is not None else None
+    except Exception as e:
+        print(f"Indicator error for {sym} {tf}: {e}")
+        return None
+
+def build_indicator_prompt(sym, tf, price, ind, lang):
+    values = (f"RSI14={ind['rsi']:.1f}; MACD={ind['macd']:.6g}, signal={ind['macd_signal']:.6g}, hist={ind['macd_hist']:.6g}; "
+              f"Bollinger(20,2) lower={ind['bb_lower']:.6g} mid={ind['bb_mid']:.6g} upper={ind['bb_upper']:.6g}; "
+              f"Volume={ind['volume_ratio']:.2f}x 20-bar avg; 20-bar low={ind['low_20']:.6g} high={ind['high_20']:.6g}")
+    if lang == "ar":
+        return f"""حلل {sym} على إطار {tf}. السعر {price:.6f}$.
+مؤشرات محسوبة (استخدمها كما هي ولا تخترع أرقاماً): {values}
+اكتب بالعربية فقط، باختصار واحترافية، وبهذا التنسيق HTML تماماً:
+
+📊 <b>التحليل العام</b>
+الاتجاه:
+
+📉 <b>الدعم والمقاومة</b>
+الدعم الأقرب:
+المقاومة الأقرب:
+
+🎯 <b>الأهداف السعرية</b>
+TP1:
+TP2:
+TP3:
+
+🛑 <b>وقف الخسارة</b>
+Stop Loss:
+
+📈 <b>تحليل المؤشرات</b>
+RSI: {ind['rsi']:.1f} — سطر واحد
+MACD: سطر واحد
+Bollinger Bands: سطر واحد
+Volume: سطر واحد
+"""
+    return f"""Analyze {sym} on the {tf} timeframe. Price ${price:.6f}.
+Computed indicators (use as given, do not invent numbers): {values}
+English only, short and professional, EXACTLY this HTML format:
+
+📊 <b>Market Overview</b>
+Trend: (Bullish / Bearish)
+
+📉 <b>Support & Resistance</b>
+Nearest Support:
+Nearest Resistance:
+
+🎯 <b>Price Targets</b>
+TP1:
+TP2:
+TP3:
+
+🛑 <b>Stop Loss</b>
+Stop Loss:
+
+📈 <b>Indicator Analysis</b>
+RSI: {ind['rsi']:.1f} — one line
+MACD: one line
+Bollinger Bands: one line
+Volume: one line
+"""
+
+# --- كاش التحليلات (ذاكرة + Postgres اختياري حتى يبقى بعد إعادة التشغيل) ---
+analysis_cache = TTLCache(ANALYSIS_TTL["daily"], ANALYSIS_CACHE_MAX)
+
+def analysis_cache_key(sym, tf, lang, price):
+    # السعر يُقرَّب إلى شرائح لوغاريتمية بعرض ANALYSIS_PRICE_BUCKET_PCT% حتى تتشارك الأسعار المتقاربة نفس التحليل
+    bucket = round(math.log(price) / math.log1p(ANALYSIS_PRICE_BUCKET_PCT / 100)) if price > 0 else 0
+    return f"{sym}:{tf}:{lang}:{bucket}"
+
+async def cached_analysis(pool, key, tf, prompt, lang, on_delta=None):
+    ttl = ANALYSIS_TTL.get(tf, ANALYSIS_TTL["daily"])
+
+    async def generate():
+        if ANALYSIS_CACHE_PERSIST:
+            try:
+                row = await pool.fetchrow("SELECT result FROM analysis_cache WHERE key = $1 AND expires_at > now()", key)
+                if row:
+                    return row['result']
+            except Exception as e:
+                print(f"Analysis cache read error: {e}")
+
+        res = await ask_groq(prompt, lang=lang, on_delta=on_delta)
+        if res == GROQ_ERROR_TEXT:
+            return None  # لا نخزن الأخطاء
+
+        if ANALYSIS_CACHE_PERSIST:
+            try:
+                await pool.execute("""
+                    INSERT INTO analysis_cache (key, result, expires_at) VALUES ($1, $2, now() + make_interval(secs => $3))
+                    ON CONFLICT (key) DO UPDATE SET result = EXCLUDED.result, expires_at = EXCLUDED.expires_at
+                """, key, res, ttl)
+            except Exception as e:
+                print(f"Analysis cache write error: {e}")
+        return res
+
+    return await analysis_cache.get(key, generate, ttl=ttl) or GROQ_ERROR_TEXT
+
+async def prune_analysis_cache(pool):
+    while True:
+        try:
+            await pool.execute("DELETE FROM analysis_cache WHERE expires_at < now()")
+        except Exception as e:
+            print(f"Analysis cache prune error: {e}")
+        await asyncio.sleep(3600)
 
 # --- التعامل مع الرموز ---
+async def show_multi_quotes(status_msg, uid, syms, lang, unknown=()):
+    # كل الرموز تمر عبر نفس الكاش والتجميع، فتصل إلى CMC كطلب واحد
+    results = await asyncio.gather(*(fetch_quote(s) for s in syms), return_exceptions=True)
+    quotes, lines, invalid = {}, [], list(unknown)
+    for sym, coin in zip(syms, results):
+        if isinstance(coin, dict):
+            price = coin["quote"]["USD"]["price"]
+            quotes[sym] = price
+            lines.append(f"💵 {sym}: ${price:.6f}")
+        else:
+            invalid.append(sym)
+
+    if not quotes:
+        return await status_msg.edit_text(i18n.text("no_valid_symbols", lang))
+
+    await session_store.set(uid, SessionEntry(lang, quotes=quotes))
+    if invalid:
+        lines.append(i18n.text("invalid_symbols", lang, symbols=", ".join(invalid)))
+    lines.append(i18n.text("select_coin", lang))
+
+    buttons = [InlineKeyboardButton(text=sym, callback_data=f"pick_{sym}") for sym in quotes]
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+    await status_msg.edit_text("\n".join(lines), reply_markup=kb)
+
+@dp.callback_query(F.data.startswith("pick_"))
+async def pick_symbol(cb: types.CallbackQuery):
+    session = await session_store.get(cb.from_user.id)
+    sym = cb.data.replace("pick_", "", 1)
+    if not session or sym not in (session.quotes or {}):
+        return await cb.answer()
+
+    lang, price = session.lang, session.quotes[sym]
+    session.sym, session.price = sym, price
+    await session_store.set(cb.from_user.id, session)
+    await cb.message.edit_text(
+        i18n.text("symbol_selected", lang, sym=sym, price=price),
+        reply_markup=i18n.kb("timeframe", lang)
+    )
+
 @dp.message(F.text)
 async def handle_symbol(m: types.Message):
     if m.text.startswith('/'):
@@ -326,96 +2499,99 @@ async def handle_symbol(m: types.Message):
     uid = m.from_user.id
     pool = dp['db_pool']
 
-    async with pool.acquire() as conn:
-        await conn.execute("""
-            INSERT INTO users_info (user_id, last_active)
-            VALUES ($1, CURRENT_DATE)
-            ON CONFLICT (user_id)
-            DO UPDATE SET last_active = CURRENT_DATE
-        """, uid)
-    # --------------------------------------------
+    track_activity(uid)
 
-    user = await pool.fetchrow("SELECT lang FROM users_info WHERE user_id = $1", uid)
-    # ... باقي كود الدالة كما هو ...
-
-    lang = user['lang'] if user else "ar"
+    ent = await get_entitlement(pool, uid)
+    lang = ent.lang
     
     # 1. التحقق من الصلاحية
-    if not (await is_user_paid(pool, uid)) and not (await has_trial(pool, uid)):
-        return await m.answer(
-            "⚠️ انتهت تجربتك المجانية. للوصول الكامل، يرجى الاشتراك مقابل 10 USDT أو 500 ⭐ لمرة واحدة." if lang=="ar" 
-            else "⚠️ Your free trial has ended. For full access, please subscribe for a one-time fee of 10 USDT or 500 ⭐.", 
-            reply_markup=get_payment_kb(lang)
-        )
+    if not ent.has_access:
+        return await m.answer(i18n.text("trial_ended", lang), reply_markup=i18n.kb("payment", lang))
     
-    sym = m.text.strip().upper()
+    syms = parse_symbols(m.text)
+    sym = syms[0] if syms else m.text.strip().upper()
+
+    # رفض الرموز غير المعروفة فوراً من الفهرس المحلي بدون طلب إلى CMC
+    unknown = []
+    if len(symbol_index):
+        resolved = []
+        for token in syms:
+            r = symbol_index.resolve(token)
+            if r:
+                resolved.append(r)
+            else:
+                unknown.append(token)
+        if not resolved:
+            return await m.answer(invalid_symbol_text(sym, lang), parse_mode=ParseMode.MARKDOWN)
+        syms = list(dict.fromkeys(resolved))
+        sym = syms[0]
     
     # 2. إرسال رسالة الانتظار وتخزينها في متغير
-    status_msg = await m.answer("⏳ جاري جلب السعر..." if lang=="ar" else "⏳ Fetching price...")
+    status_msg = await m.answer(i18n.text("fetching_price", lang))
+
+    if len(syms) + len(unknown) > 1:
+        return await show_multi_quotes(status_msg, uid, syms, lang, unknown)
 
     try:
-        async with httpx.AsyncClient() as client:
-            res = await client.get(
-                f"https://pro-api.coinmarketcap.com/v1/cryptocurrency/quotes/latest?symbol={sym}", 
-                headers={"X-CMC_PRO_API_KEY": CMC_KEY},
-                timeout=10
-            )
-            data = res.json()
-
-            # التحقق مما إذا كان الـ API قد أعاد خطأ أو لم يجد العملة
-            if res.status_code != 200 or "data" not in data or sym not in data["data"]:
-                raise ValueError("Symbol not found")
-
-            price = data["data"][sym]["quote"]["USD"]["price"]
-            
-            # تخزين البيانات في الجلسة
-            user_session_data[uid] = {"sym": sym, "price": price, "lang": lang}
-            
-            # 3. تحديث رسالة الانتظار بالخيارات الجديدة في حال النجاح
-            kb = InlineKeyboardMarkup(inline_keyboard=[[
-                InlineKeyboardButton(text="أسبوعي" if lang=="ar" else "Weekly", callback_data="tf_weekly"),
-                InlineKeyboardButton(text="يومي" if lang=="ar" else "Daily", callback_data="tf_daily"),
-                InlineKeyboardButton(text="4 ساعات" if lang=="ar" else "4H", callback_data="tf_4h")
-            ]])
-            
-            await status_msg.edit_text(
-                f"✅ العملة: {sym}\n💵 السعر: ${price:.6f}\n⏳ اختر الإطار الزمني للتحليل:" if lang=="ar" 
-                else f"✅ Symbol: {sym}\n💵 Price: ${price:.6f}\n⏳ Select timeframe for analysis:", 
-                reply_markup=kb
-            )
+        coin = await fetch_quote(sym)
+
+        # التحقق مما إذا كان الـ API قد أعاد خطأ أو لم يجد العملة
+        if coin is None:
+            raise ValueError("Symbol not found")
+
+        price = coin["quote"]["USD"]["price"]
+        
+        # تخزين البيانات في الجلسة
+        await session_store.set(uid, SessionEntry(lang, sym=sym, price=price))
+        
+        # 3. تحديث رسالة الانتظار بالخيارات الجديدة في حال النجاح
+        await status_msg.edit_text(
+            i18n.text("symbol_selected", lang, sym=sym, price=price),
+            reply_markup=i18n.kb("timeframe", lang)
+        )
 
     except Exception as e:
         # 4. في حال حدوث أي خطأ، يتم تعديل رسالة "جاري الجلب" لتوضيح الخطأ
-        error_text = (
-            f"❌ الرمز `{sym}` غير صحيح. تأكد من كتابة الرمز بشكل صحيح (مثل BTC أو ETH)." if lang=="ar" 
-            else f"❌ Symbol `{sym}` is invalid. Please check the ticker (e.g., BTC, ETH)."
-        )
-        await status_msg.edit_text(error_text, parse_mode=ParseMode.MARKDOWN)
+        await status_msg.edit_text(invalid_symbol_text(sym, lang), parse_mode=ParseMode.MARKDOWN)
 @dp.callback_query(F.data.startswith("tf_"))
 async def run_analysis(cb: types.CallbackQuery):
     uid, pool = cb.from_user.id, dp['db_pool']
-    data = user_session_data.get(uid)
-    if not data:
-        return
 
-    lang, sym, price, tf = data['lang'], data['sym'], data['price'], cb.data.replace("tf_", "")
+    # تجاهل الضغطات المتكررة أثناء وجود تحليل جارٍ لنفس المستخدم؛
+    # الفحص والإضافة قبل أول await وإلا تمر ضغطتان سريعتان معاً
+    if uid in analysis_inflight:
+        return await cb.answer(i18n.text("analysis_in_progress", cached_lang(uid)))
+    analysis_inflight.add(uid)
+    try:
+        session = await session_store.get(uid)
+        if not session or not session.sym:
+            return
+        lang, sym, price, tf = session.lang, session.sym, session.price, cb.data.replace("tf_", "")
+        await _run_analysis(cb, pool, uid, lang, sym, price, tf)
+    finally:
+        analysis_inflight.discard(uid)
+
+async def _run_analysis(cb, pool, uid, lang, sym, price, tf):
 
     # --- تحقق من الاشتراك / التجربة ---
-    if not (await is_user_paid(pool, uid)) and not (await has_trial(pool, uid)):
+    ent = await get_entitlement(pool, uid)
+    if not ent.has_access:
         return await cb.message.edit_text(
-            "⚠️ انتهت تجربتك المجانية." if lang=="ar" else "⚠️ Trial ended.",
-            reply_markup=get_payment_kb(lang)
+            i18n.text("trial_ended_short", lang),
+            reply_markup=i18n.kb("payment", lang)
         )
 
     try:
-        await cb.message.edit_text(
-            "🤖 جاري التحليل..." if lang=="ar" else "🤖 Analyzing..."
-        )
+        await cb.message.edit_text(i18n.text("analyzing", lang))
     except:
         pass
 
     # --- برومبت التحليل منسق ---
-    if lang == "ar":
+    # إذا توفرت شموع حقيقية نحسب المؤشرات محلياً ونرسل برومبت أقصر بأرقام حقيقية
+    indicators = await get_indicators(sym, tf)
+    if indicators:
+        prompt = build_indicator_prompt(sym, tf, price, indicators, lang)
+    elif lang == "ar":
         prompt = (
             f"""قم بتحليل عملة {sym}
 
@@ -484,46 +2660,49 @@ Volume: (Weak / Medium) — write one short line explaining trading activity
 """
         )
 
-    # --- استدعاء API داخل الدالة فقط ---
-    res = await ask_groq(prompt, lang=lang)
-    await cb.message.answer(res, parse_mode=ParseMode.HTML)
+    # --- استدعاء API داخل الدالة فقط (مع كاش حسب العملة/الإطار/اللغة/شريحة السعر) ---
+    # الرد يظهر تدريجياً في رسالة "جاري التحليل" نفسها ثم تُستبدل بالنص الكامل
+    editor = StreamingEditor(cb.message)
+    res = await cached_analysis(pool, analysis_cache_key(sym, tf, lang, price), tf, prompt, lang, on_delta=editor.update)
+    try:
+        await cb.message.edit_text(res, parse_mode=ParseMode.HTML)
+    except TelegramBadRequest:
+        # HTML غير صالح: نعرض النص كما هو بدل ترك الرسالة الجزئية مع مؤشر ▌
+        try:
+            await cb.message.edit_text(res, parse_mode=None)
+        except TelegramBadRequest:
+            try:
+                await cb.message.delete()
+            except TelegramAPIError:
+                pass
+            await cb.message.answer(res, parse_mode=None)
     
-    if not (await is_user_paid(pool, uid)):
+    if not ent.is_paid:
         async with pool.acquire() as conn:
-            await conn.execute("INSERT INTO trial_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", uid)
-        await cb.message.answer("⚠️ انتهت تجربتك المجانية. للوصول الكامل، يرجى الاشتراك مقابل 10 USDT أو 500 ⭐ لمرة واحدة." if lang=="ar" else "⚠️ Your free trial has ended. For full access, please subscribe for a one-time fee of 10 USDT or 500 ⭐.", reply_markup=get_payment_kb(lang))
+            await mark_trial_used(conn, uid)
+        invalidate_entitlement(uid)
+        await cb.message.answer(i18n.text("trial_ended", lang), reply_markup=i18n.kb("payment", lang))
 
 # --- الدفع الكريبتو ---
 @dp.callback_query(F.data == "pay_crypto")
 async def crypto_pay(cb: types.CallbackQuery):
     uid, pool = cb.from_user.id, dp['db_pool']
-    user = await pool.fetchrow("SELECT lang FROM users_info WHERE user_id = $1", uid)
-    lang = user['lang'] if user else "ar"
+    lang = (await get_entitlement(pool, uid)).lang
     
-    await cb.message.edit_text(
-        "⏳ يتم إنشاء رابط الدفع، يرجى الانتظار..." if lang == "ar" else "⏳ Generating payment link, please wait..."
-    )
+    await cb.message.edit_text(i18n.text("payment_link_pending", lang))
 
-    invoice_url = await create_nowpayments_invoice(cb.from_user.id)
+    invoice_url = await create_nowpayments_invoice(pool, cb.from_user.id)
     if invoice_url:
-        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="💳 ادفع الآن" if lang=="ar" else "💳 Pay Now", url=invoice_url)]])
-        msg = (
-            "✅ تم إنشاء رابط الدفع.\nلإتمام الاشتراك، ادفع عبر الرابط أدناه.\n\nUSDT (BEP20)"
-            if lang == "ar"
-            else "✅ Payment link created.\nTo complete your subscription, pay via the link below.\n\nUSDT (BEP20)"
-        )
-        await cb.message.edit_text(msg, reply_markup=kb)
+        kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text=i18n.text("btn_pay_now", lang), url=invoice_url)]])
+        await cb.message.edit_text(i18n.text("payment_link_created", lang), reply_markup=kb)
     else:
-        await cb.message.edit_text(
-            "❌ حدث خطأ. يرجى المحاولة مرة أخرى لاحقاً." if lang == "ar" else "❌ An error occurred. Please try again later."
-        )
+        await cb.message.edit_text(i18n.text("error_try_later", lang))
 
 @dp.callback_query(F.data == "pay_stars")
 async def stars_pay_call(cb: types.CallbackQuery):
     await cb.answer()
     uid, pool = cb.from_user.id, dp['db_pool']
-    user = await pool.fetchrow("SELECT lang FROM users_info WHERE user_id = $1", uid)
-    await send_stars_invoice(cb.from_user.id, lang=user['lang'] if user else "ar")
+    await send_stars_invoice(cb.from_user.id, lang=(await get_entitlement(pool, uid)).lang)
 
 @dp.pre_checkout_query()
 async def pre_checkout(q: PreCheckoutQuery): await bot.answer_pre_checkout_query(q.id, ok=True)
@@ -531,81 +2710,456 @@ async def pre_checkout(q: PreCheckoutQuery): await bot.answer_pre_checkout_query
 @dp.message(F.successful_payment)
 async def success_pay(m: types.Message):
     uid, pool = m.from_user.id, dp['db_pool']
-    user = await pool.fetchrow("SELECT lang FROM users_info WHERE user_id = $1", uid)
-    lang = user['lang'] if user else "ar"
+    lang = (await get_entitlement(pool, uid)).lang
     async with pool.acquire() as conn:
-        await conn.execute("INSERT INTO paid_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", m.from_user.id)
-    await m.answer(
-        "✅ تم تأكيد الدفع بنجاح! شكراً لاشتراكك. يمكنك الآن استخدام البوت بشكل كامل."
-        if lang == "ar" else
-        "✅ Payment confirmed! Thank you for subscribing. You can now use the bot fully."
-    )
+        await mark_paid(conn, m.from_user.id)
+    invalidate_entitlement(uid)
+    await m.answer(i18n.text("payment_confirmed", lang))
 
 # --- Webhook NOWPayments (IPN) ---
-async def nowpayments_ipn(req: web.Request):
-    try:
-        data = await req.json()
-        status = data.get("payment_status")
-        order_id = data.get("order_id") 
+PAID_STATUSES = ("finished", "confirmed")
 
-        print(f"إشعار دفع جديد: الحالة {status} للمستخدم {order_id}")
+def nowpayments_signature(data):
+    # NOWPayments يوقّع الـ JSON بعد ترتيب المفاتيح وبدون مسافات
+    payload = json.dumps(data, sort_keys=True, separators=(",", ":"))
+    return hmac.new(NOWPAYMENTS_IPN_SECRET.encode(), payload.encode(), hashlib.sha512).hexdigest()
 
-        if status in ["finished", "confirmed"]:
-            if order_id:
-                user_id = int(order_id)
-                pool = req.app['db_pool']
-                
-                async with pool.acquire() as conn:
-                    # 1. تفعيل المستخدم في جدول الـ VIP
-                    await conn.execute(
-                        "INSERT INTO paid_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
-                        user_id
-                    )
-                    
-                    # 2. جلب لغة المستخدم من قاعدة البيانات
-                    user_row = await conn.fetchrow("SELECT lang FROM users_info WHERE user_id = $1", user_id)
-                    user_lang = user_row['lang'] if user_row and user_row['lang'] else "ar"
-
-                # 3. تحديد نص الرسالة بناءً على اللغة
-                if user_lang == "ar":
-                    msg = "✅ تم تأكيد الدفع بنجاح! شكراً لاشتراكك. يمكنك الآن استخدام البوت بشكل كامل."
-                else:
-                    msg = "✅ Payment confirmed! Thank you for subscribing. You can now use the bot fully."
+async def record_payment_event(pool, payment_id, invoice_id, user_id, status):
+    """يسجل حالة الدفع مرة واحدة لكل payment_id ويعيد True فقط للنسخة التي فعّلت الاشتراك."""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO payment_events (payment_id, invoice_id, user_id, status) VALUES ($1, $2, $3, $4)
+                ON CONFLICT (payment_id) DO UPDATE SET status = EXCLUDED.status, updated_at = now()
+                    WHERE NOT payment_events.activated
+            """, payment_id, invoice_id, user_id, status)
+            if invoice_id:
+                await conn.execute("UPDATE payment_invoices SET status = $2 WHERE invoice_id = $1", invoice_id, status)
+            if status not in PAID_STATUSES:
+                return False
+            # قفل الصف يضمن أن إشعارين متزامنين لنفس الدفعة لا يفعّلان مرتين
+            activated = await conn.fetchval(
+                "UPDATE payment_events SET activated = TRUE WHERE payment_id = $1 AND NOT activated RETURNING TRUE",
+                payment_id
+            )
+            if activated:
+                await mark_paid(conn, user_id)
+    if activated:
+        invalidate_entitlement(user_id)
+        print(f"🎉 User {user_id} upgraded to VIP (payment {payment_id})")
+    return bool(activated)
+
+# مراجع قوية لمهام التأكيد الجارية؛ asyncio لا يحتفظ إلا بمرجع ضعيف وقد تُجمع المهمة قبل الإرسال
+payment_notify_tasks = set()
+
+async def notify_payment(pool, payment_id, user_id):
+    msg = i18n.text("payment_confirmed", (await get_entitlement(pool, user_id)).lang)
+    try:
+        await bot.send_message(user_id, msg)
+    except TelegramForbiddenError:
+        pass
+    except Exception as e:
+        print(f"Could not send message to user {user_id}: {e}")
+        return  # تعيد المطابقة المحاولة لاحقاً
+    await pool.execute("UPDATE payment_events SET notified = TRUE WHERE payment_id = $1", payment_id)
 
-                # 4. إرسال الرسالة
-                try:
-                    await bot.send_message(user_id, msg)
-                except Exception as e:
-                    print(f"Could not send message to user {user_id}: {e}")
-                
-                print(f"🎉 User {user_id} upgraded to VIP ({user_lang})")
+async def nowpayments_ipn(req: web.Request):
+    raw = await req.read()
+    try:
+        data = json_loads(raw)
+    except ValueError:
+        return web.Response(text="bad request", status=400)
+
+    if not NOWPAYMENTS_IPN_SECRET or not hmac.compare_digest(
+        req.headers.get("x-nowpayments-sig", ""), nowpayments_signature(data)
+    ):
+        print("IPN rejected: invalid signature")
+        return web.Response(text="invalid signature", status=401)
 
+    try:
+        status = data.get("payment_status")
+        order_id = data.get("order_id")
+        payment_id = data.get("payment_id")
+        print(f"إشعار دفع جديد: الحالة {status} للمستخدم {order_id}")
+        if not order_id or payment_id is None:
+            return web.Response(text="ok")
+
+        user_id = int(order_id)
+        invoice_id = str(data["invoice_id"]) if data.get("invoice_id") else None
+        pool = req.app['db_pool']
+        if await record_payment_event(pool, int(payment_id), invoice_id, user_id, status):
+            # الرد فوراً؛ رسالة التأكيد لا تؤخر NOWPayments حتى لا يعيد الإرسال
+            task = asyncio.create_task(notify_payment(pool, int(payment_id), user_id))
+            payment_notify_tasks.add(task)
+            task.add_done_callback(payment_notify_tasks.discard)
         return web.Response(text="ok")
     except Exception as e:
         print(f"IPN Error: {e}")
         return web.Response(text="error", status=500)
 
+async def nowpayments_token():
+    res = await upstream_request("nowpayments", "POST", "/v1/auth",
+                                 json={"email": NOWPAYMENTS_EMAIL, "password": NOWPAYMENTS_PASSWORD})
+    return res.json().get("token")
+
+async def reconcile_payments(pool):
+    # تعمل على القائد فقط: تعيد إرسال التأكيدات الفاشلة وتسحب حالة الفواتير التي لم يصل لها IPN دفعة واحدة
+    while True:
+        await asyncio.sleep(PAYMENT_RECONCILE_INTERVAL)
+        try:
+            for r in await pool.fetch(
+                "SELECT payment_id, user_id FROM payment_events "
+                "WHERE activated AND NOT notified AND updated_at < now() - interval '1 minute'"
+            ):
+                await notify_payment(pool, r['payment_id'], r['user_id'])
+
+            open_invoices = {
+                r['invoice_id']: r for r in await pool.fetch(
+                    "SELECT invoice_id, user_id, created_at FROM payment_invoices "
+                    "WHERE status = 'waiting' AND created_at BETWEEN now() - interval '3 days' AND now() - interval '10 minutes'"
+                )
+            }
+            if not open_invoices or not (NOWPAYMENTS_EMAIL and NOWPAYMENTS_PASSWORD):
+                continue
+
+            token = await nowpayments_token()
+            date_from = min(r['created_at'] for r in open_invoices.values()).strftime("%Y-%m-%d")
+            page = 0
+            while True:
+                res = await upstream_request(
+                    "nowpayments", "GET", "/v1/payment/",
+                    params={"limit": 500, "page": page, "dateFrom": date_from, "sortBy": "created_at", "orderBy": "asc"},
+                    headers={"Authorization": f"Bearer {token}"},
+                )
+                body = res.json()
+                for p in body.get("data", []):
+                    invoice = open_invoices.get(str(p.get("invoice_id")))
+                    if invoice is None:
+                        continue
+                    if await record_payment_event(pool, int(p["payment_id"]), invoice['invoice_id'],
+                                                  invoice['user_id'], p.get("payment_status")):
+                        await notify_payment(pool, int(p["payment_id"]), invoice['user_id'])
+                page += 1
+                if page >= body.get("pagesCount", 1):
+                    break
+        except Exception as e:
+            print(f"Payment reconcile error: {e}")
+
+
+# --- التحكم في قبول التحديثات قبل الـ Dispatcher ---
+class UserRateLimiter:
+    """دلو رموز لكل مستخدم (user_id -> [tokens, last]) مع حد أقصى لعدد المستخدمين المتتبعين."""
+
+    def __init__(self, rate, burst, max_users):
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self._buckets = OrderedDict()
+
+    def allow(self, user_id):
+        now = time.monotonic()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = [self.burst, now]
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            return True
+        return False
+
+user_limiter = UserRateLimiter(USER_RATE, USER_BURST, USER_LIMITER_MAX)
+ingress_queue = asyncio.Queue(maxsize=INGRESS_QUEUE_SIZE)
+admission_stats = {"accepted": 0, "rate_limited": 0, "overloaded": 0, "unauthorized": 0, "dropped": 0, "inflight": 0}
+analysis_inflight = set()
+# أنواع التحديثات التي لها معالجات فعلاً؛ تُحدّث عند التشغيل من الـ Dispatcher نفسه
+handled_update_types = {"message", "callback_query", "pre_checkout_query"}
+
+def update_user_id(data):
+    for key in ("message", "edited_message", "callback_query", "pre_checkout_query"):
+        sender = (data.get(key) or {}).get("from")
+        if sender:
+            return sender.get("id")
+    return None
+
+async def ingress_worker():
+    # تحويل JSON إلى types.Update يحدث هنا، خارج مسار الرد على تيليجرام
+    while True:
+        data, received_at = await ingress_queue.get()
+        admission_stats["inflight"] += 1
+        try:
+            await dp.feed_update(bot, types.Update(**data))
+        except Exception as e:
+            print(f"Update handling error: {e}")
+        finally:
+            admission_stats["inflight"] -= 1
+            update_seconds.observe(time.perf_counter() - received_at)
+            ingress_queue.task_done()
+
+def start_ingress_workers():
+    for _ in range(MAX_INFLIGHT_UPDATES):
+        asyncio.create_task(ingress_worker())
+
+# --- طابور التحديثات المشترك (وضع SCALE_MODE=queue: الويب يستقبل فقط والعمال يعالجون) ---
+def update_chat_id(data):
+    for key in ("message", "edited_message"):
+        chat = (data.get(key) or {}).get("chat")
+        if chat:
+            return chat.get("id")
+    return update_user_id(data) or 0
+
+async def enqueue_update(pool, data, raw):
+    # نخزن الجسم كما وصل بدل إعادة تسلسل الـ JSON
+    await pool.execute("""
+        WITH ins AS (
+            INSERT INTO update_queue (update_id, chat_id, payload) VALUES ($1, $2, $3)
+            ON CONFLICT (update_id) DO NOTHING
+            RETURNING id
+        )
+        SELECT pg_notify('update_queued', '') FROM ins
+    """, data.get("update_id"), update_chat_id(data), raw.decode())
+
+# لا يُسحب تحديث إلا إذا لم يكن قبله تحديث لنفس المحادثة في الطابور (قيد الانتظار أو قيد المعالجة)،
+# وبهذا يبقى ترتيب كل محادثة محفوظاً مهما كان عدد العمال
+UPDATE_CLAIM_SQL = """
+    WITH next AS (
+        SELECT q.id FROM update_queue q
+        WHERE q.status = 'pending'
+          AND NOT EXISTS (SELECT 1 FROM update_queue p WHERE p.chat_id = q.chat_id AND p.id < q.id)
+        ORDER BY q.id
+        LIMIT 1
+        FOR UPDATE SKIP LOCKED
+    )
+    UPDATE update_queue u SET status = 'processing', claimed_at = now()
+    FROM next WHERE u.id = next.id
+    RETURNING u.id, u.payload, u.received_at
+"""
+
+# إشعار واحد يوقظ كل العمال الخاملين في هذه العملية؛ العداد يلتقط إشعاراً وصل بين السحب الفارغ وبدء الانتظار
+update_wakeup = asyncio.Event()
+update_wakeup_seq = 0
+
+def _on_update_queued(*_):
+    global update_wakeup_seq
+    update_wakeup_seq += 1
+    update_wakeup.set()
+    update_wakeup.clear()
+
+async def update_queue_listener():
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(DATABASE_URL)
+            await conn.add_listener("update_queued", _on_update_queued)
+            # ما وصل أثناء الانقطاع لم يُشعَر به أحد
+            _on_update_queued()
+            while not conn.is_closed():
+                await asyncio.sleep(LEADER_HEARTBEAT)
+                await conn.fetchval("SELECT 1")
+        except Exception as e:
+            print(f"Update queue listener error: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                await conn.close()
+        await asyncio.sleep(5)
+
+async def keep_claim(pool, update_id):
+    # تحليل بطيء لكنه حي قد يتجاوز المهلة (محاولات Groq ثم النموذج الاحتياطي)، فنجدد الحجز حتى لا يُعاد تنفيذه
+    while True:
+        await asyncio.sleep(UPDATE_CLAIM_TIMEOUT / 3)
+        try:
+            await pool.execute("UPDATE update_queue SET claimed_at = now() WHERE id = $1", update_id)
+        except Exception as e:
+            print(f"Update claim refresh error: {e}")
+
+async def update_worker(pool):
+    while True:
+        seq = update_wakeup_seq
+        try:
+            row = await pool.fetchrow(UPDATE_CLAIM_SQL)
+        except Exception as e:
+            print(f"Update queue claim error: {e}")
+            await asyncio.sleep(1)
+            continue
+        if row is None:
+            if seq == update_wakeup_seq:
+                try:
+                    await asyncio.wait_for(update_wakeup.wait(), timeout=UPDATE_QUEUE_POLL)
+                except asyncio.TimeoutError:
+                    pass
+            continue
+        claim = asyncio.create_task(keep_claim(pool, row['id']))
+        try:
+            await dp.feed_update(bot, types.Update(**json_loads(row['payload'])))
+        except Exception as e:
+            print(f"Update worker error: {e}")
+        finally:
+            claim.cancel()
+        update_seconds.observe(max(0.0, time.time() - row['received_at'].timestamp()))
+        try:
+            # حذف الصف قد يحرر التحديث التالي لنفس المحادثة، فنوقظ العمال الآخرين
+            await pool.execute("""
+                WITH done AS (DELETE FROM update_queue WHERE id = $1 RETURNING chat_id)
+                SELECT pg_notify('update_queued', '')
+                FROM done WHERE EXISTS (SELECT 1 FROM update_queue q WHERE q.chat_id = done.chat_id AND q.id <> $1)
+            """, row['id'])
+        except Exception as e:
+            # الصف يبقى "قيد المعالجة" ويعيده requeue_stale_updates بعد المهلة
+            print(f"Update queue ack error: {e}")
+
+async def requeue_stale_updates(pool):
+    # تحديث بقي "قيد المعالجة" أطول من المهلة يعني أن العامل مات؛ نعيده للطابور
+    while True:
+        await asyncio.sleep(UPDATE_CLAIM_TIMEOUT / 2)
+        try:
+            await pool.execute("""
+                WITH stale AS (
+                    UPDATE update_queue SET status = 'pending', claimed_at = NULL
+                    WHERE status = 'processing' AND claimed_at < now() - make_interval(secs => $1)
+                    RETURNING id
+                )
+                SELECT pg_notify('update_queued', '') WHERE EXISTS (SELECT 1 FROM stale)
+            """, UPDATE_CLAIM_TIMEOUT)
+        except Exception as e:
+            print(f"Update requeue error: {e}")
+
+def start_update_workers(pool):
+    for i in range(UPDATE_WORKERS):
+        spawn_background(f"update_worker_{i}", update_worker(pool))
+    spawn_background("update_queue_listener", update_queue_listener())
+    spawn_background("requeue_stale_updates", requeue_stale_updates(pool))
+
+# --- انتخاب القائد (نسخة واحدة فقط تشغل الرادار ومنشور القناة) ---
+class LeaderElection:
+    """
+    كل أقفال القيادة على اتصال مخصص واحد خارج الـ pool، فلا تحجز المهام القيادية اتصالات المعالجات.
+    القفل الاستشاري مربوط بالاتصال؛ إذا ماتت النسخة أو انقطع الاتصال تتحرر كل الأقفال وتستلم نسخة أخرى.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.jobs = {}     # اسم القفل -> دالة المهمة
+        self.running = {}  # اسم القفل -> المهمة الجارية
+
+    def add(self, name, job):
+        self.jobs[name] = job
+
+    async def run(self):
+        while True:
+            conn = None
+            try:
+                conn = await asyncpg.connect(DATABASE_URL)
+                while True:
+                    await conn.fetchval("SELECT 1")
+                    for name, task in list(self.running.items()):
+                        if task.done():
+                            self._report(name, task)
+                            del self.running[name]
+                            await conn.execute("SELECT pg_advisory_unlock(hashtext($1))", name)
+                    for name, job in self.jobs.items():
+                        if name not in self.running and await conn.fetchval("SELECT pg_try_advisory_lock(hashtext($1))", name):
+                            print(f"👑 Leader for {name}")
+                            self.running[name] = asyncio.create_task(job(self.pool))
+                    await asyncio.sleep(LEADER_HEARTBEAT)
+            except Exception as e:
+                print(f"Leader election error: {e}")
+            finally:
+                # بدون الاتصال لم تعد الأقفال مضمونة، فنوقف المهام حتى لا تعمل نسختان معاً
+                for task in self.running.values():
+                    task.cancel()
+                self.running.clear()
+                if conn is not None and not conn.is_closed():
+                    await conn.close()
+            await asyncio.sleep(LEADER_HEARTBEAT)
+
+    @staticmethod
+    def _report(name, task):
+        if task.cancelled():
+            print(f"Leader job {name} was cancelled, restarting")
+        elif task.exception() is not None:
+            print(f"Leader job {name} crashed, restarting: {task.exception()!r}")
+        else:
+            print(f"Leader job {name} exited, restarting")
 
 # --- السيرفر ---
 async def handle_webhook(req: web.Request):
+    started = time.perf_counter()
+    try:
+        return await _handle_webhook(req, started)
+    finally:
+        webhook_ack_seconds.observe(time.perf_counter() - started)
+
+async def _handle_webhook(req, received_at):
+    # التحقق من أن الطلب من تيليجرام قبل قراءة الجسم
+    if not hmac.compare_digest(req.headers.get("X-Telegram-Bot-Api-Secret-Token", ""), SECRET_TOKEN):
+        admission_stats["unauthorized"] += 1
+        return web.Response(text="unauthorized", status=401)
+
     try:
-        data = await req.json()
-        asyncio.create_task(dp.feed_update(bot, types.Update(**data)))
+        raw = await req.read()
+        data = json_loads(raw)
+
+        # أنواع لا نعالجها (edited_message, channel_post...) لا تصل إلى aiogram أصلاً
+        if not handled_update_types.intersection(data):
+            admission_stats["dropped"] += 1
+            return web.Response(text="ok")
+
+        # الدفع لا يخضع لحد المستخدم حتى لا يضيع تأكيد دفع
+        uid = update_user_id(data)
+        is_payment = "pre_checkout_query" in data or ((data.get("message") or {}).get("successful_payment") is not None)
+        if uid is not None and not is_payment and not user_limiter.allow(uid):
+            admission_stats["rate_limited"] += 1
+            if "callback_query" in data:
+                # بدون رد يبقى الزر في حالة تحميل؛ نجيب عبر رد الـ webhook نفسه بلا طلب إضافي لتيليجرام
+                return web.json_response({
+                    "method": "answerCallbackQuery",
+                    "callback_query_id": data["callback_query"]["id"],
+                    "text": i18n.text("slow_down", cached_lang(uid)),
+                })
+            return web.Response(text="ok")
+
+        if SCALE_MODE == "queue":
+            await enqueue_update(req.app['db_pool'], data, raw)
+            admission_stats["accepted"] += 1
+            return web.Response(text="ok")
+
+        # طابور محدود: إذا امتلأ نرد 503 فوراً ليعيد تيليجرام الإرسال لاحقاً بدل تراكم المهام في الذاكرة
+        try:
+            ingress_queue.put_nowait((data, received_at))
+        except asyncio.QueueFull:
+            admission_stats["overloaded"] += 1
+            return web.Response(text="busy", status=503)
+
+        admission_stats["accepted"] += 1
         return web.Response(text="ok")
+    except ValueError:
+        return web.Response(text="bad request", status=400)
     except Exception as e:
         print(f"Webhook error: {e}")
         return web.Response(text="error", status=500)
 
-async def on_startup(app):
-    pool = await asyncpg.create_pool(
+async def create_db_pool():
+    return await asyncpg.create_pool(
         DATABASE_URL,
         min_size=1,
         max_size=10,
         command_timeout=60,
-        timeout=60
+        timeout=60,
+        init=_init_db_connection,
     )
 
-    app['db_pool'] = dp['db_pool'] = pool
+async def _init_db_connection(conn):
+    if hasattr(conn, "add_query_logger"):  # asyncpg >= 0.29
+        conn.add_query_logger(_record_query)
+
+async def init_services(pool):
+    dp['db_pool'] = pool
+    session_store.bind(pool)
+    await open_http_clients()
 
     # 🔥 تأكد الاتصال اشتغل قبل استقبال المستخدمين
     try:
@@ -614,27 +3168,86 @@ async def on_startup(app):
         print("✅ Database connected successfully")
     except Exception as e:
         print(f"❌ Database connection failed: {e}")
+    await run_migrations(pool)
+
+    # ✅ إضافة المستخدمين المدفوعين مباشرة بدون تكرار
+    initial_paid_users = {1811762192, 756814703}  # استخدام مجموعة لتجنب التكرار
     async with pool.acquire() as conn:
-        await conn.execute("CREATE TABLE IF NOT EXISTS users_info (user_id BIGINT PRIMARY KEY, lang TEXT)")
-        # داخل دالة on_startup ابحث عن سطر إنشاء الجداول وأضف هذا:
-        await conn.execute("ALTER TABLE users_info ADD COLUMN IF NOT EXISTS last_active DATE")
-        await conn.execute("CREATE TABLE IF NOT EXISTS paid_users (user_id BIGINT PRIMARY KEY)")
-        await conn.execute("CREATE TABLE IF NOT EXISTS trial_users (user_id BIGINT PRIMARY KEY)")
-        
-        # ✅ إضافة المستخدمين المدفوعين مباشرة بدون تكرار
-        initial_paid_users = {1811762192, 756814703}  # استخدام مجموعة لتجنب التكرار
         for uid in initial_paid_users:
-            await conn.execute("INSERT INTO paid_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING", uid)
-    
-    asyncio.create_task(ai_opportunity_radar(pool))  # تم التعليق لإيقاف الرادار عند التشغيل
-    asyncio.create_task(daily_channel_post())
-    await bot.set_webhook(f"{WEBHOOK_URL}/")
+            await mark_paid(conn, uid)
+    asyncio.create_task(runtime_monitor(pool))
+
+def start_background_tasks(pool):
+    leaders = LeaderElection(pool)
+    leaders.add("ai_opportunity_radar", ai_opportunity_radar)
+    leaders.add("daily_channel_post", daily_channel_post)
+    leaders.add("reconcile_payments", reconcile_payments)
+    leaders.add("market_data", market_data.run)
+    leaders.add("symbol_index", refresh_symbol_index)
+    spawn_background("broadcast_jobs", process_broadcast_jobs(pool))
+    spawn_background("activity_flusher", activity_flusher(pool))
+    spawn_background("session_pruner", session_pruner())
+    if ANALYSIS_CACHE_PERSIST:
+        spawn_background("analysis_cache_pruner", prune_analysis_cache(pool))
+    load_symbol_snapshot()
+    spawn_background("leader_election", leaders.run())
+    spawn_background("market_follower", follow_shared_market_data(pool))
+    if SCALE_MODE == "queue":
+        spawn_background("entitlement_listener", entitlement_listener())
+
+async def on_startup(app):
+    pool = await create_db_pool()
+    app['db_pool'] = pool
+    app['http_stats'] = http_stats
+    await init_services(pool)
+
+    # web: استقبال فقط وكل المعالجة في عمليات worker منفصلة
+    if PROCESS_ROLE != "web":
+        start_background_tasks(pool)
+        if SCALE_MODE == "queue":
+            start_update_workers(pool)
+    if SCALE_MODE != "queue":
+        start_ingress_workers()
+
+    allowed_updates = dp.resolve_used_update_types()
+    handled_update_types.clear()
+    handled_update_types.update(allowed_updates)
+    await bot.set_webhook(f"{WEBHOOK_URL}/", secret_token=SECRET_TOKEN, allowed_updates=allowed_updates)
+
+async def run_worker():
+    # عملية معالجة بدون سيرفر ويب؛ شغّل منها العدد الذي تريده (عادة واحدة لكل نواة)
+    pool = await create_db_pool()
+    await init_services(pool)
+    start_background_tasks(pool)
+    start_update_workers(pool)
+    print(f"⚙️ Update worker started ({UPDATE_WORKERS} consumers)")
+
+    if METRICS_PORT:
+        metrics_app = web.Application()
+        metrics_app['db_pool'] = pool
+        metrics_app.router.add_get("/metrics", metrics_handler)
+        metrics_app.router.add_get("/health", health_handler)
+        runner = web.AppRunner(metrics_app)
+        await runner.setup()
+        await web.TCPSite(runner, "0.0.0.0", METRICS_PORT).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await flush_activity(pool)
+        await close_http_clients()
+        await pool.close()
 
 app = web.Application()
 app.router.add_post("/", handle_webhook)
 app.router.add_post("/webhook/nowpayments", nowpayments_ipn)
-app.router.add_get("/health", lambda r: web.Response(text="ok"))
+app.router.add_get("/health", health_handler)
+app.router.add_get("/metrics", metrics_handler)
 app.on_startup.append(on_startup)
+app.on_shutdown.append(lambda app: flush_activity(app['db_pool']))
+app.on_cleanup.append(close_http_clients)
 
 if __name__ == "__main__":
-    web.run_app(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    if PROCESS_ROLE == "worker":
+        asyncio.run(run_worker())
+    else:
+        web.run_app(app, host="0.0.0.0", port=PORT)
\ No newline at end of file